@@ -14,7 +14,9 @@ import gv  # Get access to ospi's settings
 from urls import urls  # Get access to ospi's URLs
 from ospi import template_render
 from webpages import ProtectedPage
+from plugins import plugin_services
 from helpers import timestr
+from blinker import signal
 
 from email import Encoders
 import smtplib
@@ -30,6 +32,9 @@ urls.extend(['/emla', 'plugins.email_adj.settings',
 # Add this plugin to the home page plugins menu
 gv.plugin_menu.append(['Email settings', '/emla'])
 
+RAIN_CHECK_INTERVAL = 10  # seconds between rain sensor checks, there is no signal for it
+IDLE_CHECK = 3600  # seconds, zone changes and saved settings wake the thread earlier
+
 ################################################################################
 # Main function loop:                                                          #
 ################################################################################
@@ -39,10 +44,9 @@ class EmailSender(Thread):
     def __init__(self):
         Thread.__init__(self)
         self.daemon = True
-        self.start()
         self.status = ''
-
-        self._sleep_time = 0
+        self._sleeper = plugin_services.Sleeper()
+        self.start()
 
     def add_status(self, msg):
         if self.status:
@@ -52,13 +56,10 @@ class EmailSender(Thread):
         print msg
 
     def update(self):
-        self._sleep_time = 0
+        self._sleeper.wake()
 
     def _sleep(self, secs):
-        self._sleep_time = secs
-        while self._sleep_time > 0:
-            time.sleep(1)
-            self._sleep_time -= 1
+        self._sleeper.sleep(secs)
 
     def try_mail(self, subject, text, attachment=None):
         self.status = ''
@@ -86,6 +87,7 @@ class EmailSender(Thread):
 
         while True:
             try:
+                dataeml = get_email_options()  # cached, reread only when the file changed
                 # send if rain detected
                 if dataeml["emlrain"] != "off":             # if eml_rain send email is enable (on)
                     if gv.sd['rs'] != last_rain:            # send email only 1x if  gv.sd rs change
@@ -133,7 +135,8 @@ class EmailSender(Thread):
 
                         self.try_mail(subject, logline)     # send email without attachment
 
-                self._sleep(1)
+                # station changes wake the thread through the zone_change signal
+                self._sleep(RAIN_CHECK_INTERVAL if dataeml["emlrain"] != "off" else IDLE_CHECK)
 
             except Exception:
                 exc_type, exc_value, exc_traceback = sys.exc_info()
@@ -144,6 +147,13 @@ class EmailSender(Thread):
 
 checker = EmailSender()
 
+
+def notify_zone_change(name, **kw):
+    checker.update()
+
+zones = signal('zone_change')
+zones.connect(notify_zone_change)
+
 ################################################################################
 # Helper functions:                                                            #
 ################################################################################
@@ -161,8 +171,7 @@ def get_email_options():
         'status': checker.status
     }
     try:
-        with open('./data/email_adj.json', 'r') as f:  # Read the settings from file
-            file_data = json.load(f)
+        file_data = plugin_services.settings.load('./data/email_adj.json')  # Read the settings from file
         for key, value in file_data.iteritems():
             if key in dataeml:
                 dataeml[key] = value
@@ -233,6 +242,6 @@ class update(ProtectedPage):
             qdict['emlrain'] = 'off'
         if 'emlrun' not in qdict:
             qdict['emlrun'] = 'off'
-        with open('./data/email_adj.json', 'w') as f:  # write the settings to file
-            json.dump(qdict, f)
+        plugin_services.settings.save('./data/email_adj.json', qdict)  # write the settings to file
+        checker.update()
         raise web.seeother('/')
@@ -1,18 +1,20 @@
 # !/usr/bin/env python
 #  This plugin includes example functions that are triggered by events in sip.py
 
-# Note: RPi direct interface to sensors is not currently supported even though the option
-#  is given in the settings page.  There's some skeleton code ready below where support can
-#  be added if we decide it's important.
+# Note: flow sensors can be connected to an Arduino that talks to the RPi over a serial port
+#  or directly to RPi input pins (RaspberryPi-GPIO interface, see GPIOPulseCounter below).
 
 # Operation: at the lowest level, the flow sensor generates a series of pulses on an input
 # pin of the Arduino or RPi that is related to the flow rate by a forumla given by the
 # specs for the flow sensor.  This pulse is used to increment a software counter on
 # the Arudino or RPi using an interrupt routine.
 
-# This plugin creates a thread that runs every N seconds (e.g. 3 seconds) and that reads
-# this counter and determines both the current flow rate (liters or gallons per hour)
-# and the total amount of water flow (in liters or gallons) since the counter was reset.
+# This plugin creates a sampling thread that reads this counter and determines both the
+# current flow rate (liters or gallons per hour) and the total amount of water flow
+# (in liters or gallons) since the counter was reset.  The thread samples quickly
+# (every "active_interval" seconds) while any station is on and drops back to a slow
+# idle rate ("idle_interval" seconds) when all valves are closed.  A zone_change signal
+# wakes the thread immediately so the first samples of a run are not missed.
 
 # The flow rates and flow amounts for each station is stored in a gv.plugin_data['fs']
 # dictionary.
@@ -25,179 +27,978 @@ from sip import template_render  #  Needed for working with web.py templates
 from webpages import ProtectedPage  # Needed for security
 import json  # for working with data file
 import time
-from threading import Thread
+from threading import Thread, Lock, RLock, current_thread
+from array import array  # fixed size storage for the flow history
 import random
+import atexit
+import struct
+import bisect
+from collections import deque
+from plugins import plugin_services
 import serial     #Since sip.py is run as root you need to install pyserial using sudo pip3
 from blinker import signal
 
 # Add new URLs to access classes in this plugin.
 urls.extend([
     u"/flow_sensors-sp", u"plugins.flow_sensors.settings",
-    u"/flow_sensors-save", u"plugins.flow_sensors.save_settings"
+    u"/flow_sensors-save", u"plugins.flow_sensors.save_settings",
+    u"/flow_sensors-history", u"plugins.flow_sensors.history",
+    u"/flow_sensors-ledger", u"plugins.flow_sensors.ledger",
+    u"/flow_sensors-log", u"plugins.flow_sensors.debug_log"
     ])
 
 gv.plugin_menu.append([u"Flow Sensors Plugin", u"/flow_sensors-sp"])
 
+ #############################################
+ # Logging
+ #############################################
+# Messages go to an in-memory ring (all levels, formatted only when the ring is dumped at
+# /flow_sensors-log) and, from the "log_level" setting up, to stdout.  A message that
+# repeats is printed at most once every LOG_RATE_LIMIT seconds with a count of the copies
+# that were suppressed, so the sampling loop does not flood the system journal.
+LOG_LEVELS = {u"debug": 10, u"info": 20, u"warning": 30, u"error": 40}
+LOG_RATE_LIMIT = 60.0  # seconds
+LOG_RING_SIZE = 500
+
+class FlowLog(object):
+    """
+    Leveled, rate limited logger for the plugin with a debug ring of recent messages.
+    """
+    def __init__(self, size=LOG_RING_SIZE):
+        self.ring = deque(maxlen=size)
+        self._printed = {}  # message format -> time it was last printed
+        self._suppressed = {}  # message format -> copies not printed since
+
+    def level(self):
+        try:
+            return gv.plugin_data[u"fs"][u"settings"][u"log_level"]
+        except KeyError:
+            return u"info"
+
+    def log(self, level, fmt, *args):
+        now = time.time()
+        self.ring.append((now, level, fmt, args))
+        if LOG_LEVELS[level] < LOG_LEVELS.get(self.level(), 20):
+            return
+        last = self._printed.get(fmt)
+        if last is not None and now - last < LOG_RATE_LIMIT:
+            self._suppressed[fmt] = self._suppressed.get(fmt, 0) + 1
+            return
+        self._printed[fmt] = now
+        msg = fmt.format(*args)
+        suppressed = self._suppressed.pop(fmt, 0)
+        if suppressed:
+            msg += u" ({} similar messages suppressed)".format(suppressed)
+        print(u"flow_sensors {}: {}".format(level, msg))
+
+    def debug(self, fmt, *args):
+        self.log(u"debug", fmt, *args)
+
+    def info(self, fmt, *args):
+        self.log(u"info", fmt, *args)
+
+    def warning(self, fmt, *args):
+        self.log(u"warning", fmt, *args)
+
+    def error(self, fmt, *args):
+        self.log(u"error", fmt, *args)
+
+    def dump(self):
+        """
+        Returns the messages in the ring as text, oldest first.
+        """
+        lines = []
+        for t, level, fmt, args in list(self.ring):
+            lines.append(u"{} {}: {}".format(time.strftime(u"%Y-%m-%d %H:%M:%S", time.localtime(t)), level,
+                                             fmt.format(*args)))
+        return u"\n".join(lines)
+
+log = FlowLog()
+
 #CONVERSION_MULTIPLIER = {u"Seeed 1/2 inch": {u"Liters": 60.0/7.5, u"Gallons": 60/7.5/3.78541},
 #                         u"Seeed 3/4 inch": {u"Liters": 60.0/5.5, u"Gallons": 60/5.5/3.78541}}
 
+LITERS_PER_GALLON = 3.78541
+
 def fixPerHour():  # recalculate settings derived from other settings
     isLiters = gv.plugin_data[u"fs"][u"settings"][u"units"] == u"Liters"
     gv.plugin_data[u"fs"][u"settings"][u"rate_units"] = u"LpH" if isLiters else u"GpH"
+    # counter to amount/rate multipliers, computed here once instead of on every sample
+    amt_conv_mult = 1.0/float(gv.plugin_data[u"fs"][u"settings"][u"pulses_per_liter"])  # liters per pulse
+    if not isLiters:
+        amt_conv_mult /= LITERS_PER_GALLON
+    gv.plugin_data[u"fs"][u"amt_conv_mult"] = amt_conv_mult
+    gv.plugin_data[u"fs"][u"rate_conv_mult"] = 60.*60.*amt_conv_mult  # pulses per second to units per hour
+
+def station_count():
+    return gv.sd[u"nbrd"]*8
+
+def allocate_flow_vectors():
+    """
+    Preallocates the per-station vectors used by update_flow_values, one entry per station
+      on all boards.  They are only reallocated when the number of boards changes.
+    """
+    n = station_count()
+    if len(gv.plugin_data[u"fs"].get(u"rates", [])) == n and u"curr_read_cntrs" in gv.plugin_data[u"fs"]:
+        return
+    for key in [u"rates", u"program_amounts", u"amount_deltas", u"prev_read_cntrs", u"curr_read_cntrs",
+                u"simulated_counters", u"run_starts", u"run_seconds", u"run_programs", u"ledger_amounts"]:
+        gv.plugin_data[u"fs"][key] = array("d", [0.0]) * n
 
 
-print(u"flow sensors plugin loaded...")
+log.info(u"flow sensors plugin loaded...")
 # initialize settings and other variables in gv
 gv.plugin_data[u"fs"] = {}
-gv.plugin_data[u"fs"][u"rates"] = [0]*8
 gv.plugin_data[u"fs"][u"settings"] = {}
 gv.plugin_data[u"fs"][u"settings"][u"interface"] = u"Simulated"
 gv.plugin_data[u"fs"][u"settings"][u"sensor_type"] = u"Seeed/Digiten 1/2 inch"
 gv.plugin_data[u"fs"][u"settings"][u"pulses_per_liter"] = 450.0
 gv.plugin_data[u"fs"][u"settings"][u"units"] = u"Liters"
 gv.plugin_data[u"fs"][u"settings"][u"rate_units"] = u"LpH"
+gv.plugin_data[u"fs"][u"settings"][u"serial_port"] = u"/dev/ttyACM0"
+gv.plugin_data[u"fs"][u"settings"][u"serial_protocol"] = u"ASCII"  # "ASCII" (polled RD/RS lines) or "Binary" (streamed frames)
+gv.plugin_data[u"fs"][u"settings"][u"log_level"] = u"warning"  # lowest level printed to stdout
+gv.plugin_data[u"fs"][u"settings"][u"flow_alarms"] = u"off"  # leak/burst alarms
+gv.plugin_data[u"fs"][u"settings"][u"leak_rate"] = 6.0  # rate (in rate_units) that counts as a leak while all valves are closed
+gv.plugin_data[u"fs"][u"settings"][u"burst_factor"] = 1.5  # rate above baseline*burst_factor counts as a burst
+gv.plugin_data[u"fs"][u"settings"][u"gpio_pins"] = u""  # comma separated input pins, one per station (RaspberryPi-GPIO)
+gv.plugin_data[u"fs"][u"settings"][u"active_interval"] = 0.5  # seconds between samples while a valve is open
+gv.plugin_data[u"fs"][u"settings"][u"idle_interval"] = 30.0  # seconds between samples while all valves are closed
 fixPerHour()
 
-print(u"Settings initialized to: " + str(gv.plugin_data[u"fs"][u"settings"]))
+log.debug(u"Settings initialized to: {}", gv.plugin_data[u"fs"][u"settings"])
 try:
     with open(u"./data/flow_sensors.json", u"r") as f:  # Read settings from json file if it exists
-        gv.plugin_data[u"fs"][u"settings"] = json.load(f)
-        print(u"Updating settings from json file: " + str(gv.plugin_data[u"fs"][u"settings"]))
+        gv.plugin_data[u"fs"][u"settings"].update(json.load(f))  # keep defaults for keys added since the file was saved
+        log.debug(u"Updating settings from json file: {}", gv.plugin_data[u"fs"][u"settings"])
 except IOError:  # If file does not exist return empty value
-    print(u"No flow_sensors.json file")
-    print(u"my settings here are: " + str(gv.plugin_data[u"fs"][u"settings"]))
+    log.info(u"No flow_sensors.json file, using default settings")
+fixPerHour()
+allocate_flow_vectors()
 
 
 # add this plugin's log value to the SIP log
 try:
     gv.logged_values.append( [_(u"usage"), lambda : u"{:.2f}".format(gv.plugin_data[u"fs"][u"program_amounts"][gv.lrun[0]]) ])
 except AttributeError:
-    print(u"gv.logged_values doesn't exist so logging not available for flow_sensor plugin")
+    log.warning(u"gv.logged_values doesn't exist so logging not available for flow_sensor plugin")
+
+
+ #############################################
+ # Flow history
+ #############################################
+# Each station keeps three fixed size rings: raw samples, one minute rollups and one hour
+# rollups.  Every entry holds a timestamp, the mean flow rate and the volume of water used
+# over the sample/bucket, in the units selected in the settings.  The rings are allocated
+# once so memory use stays flat however long SIP runs.
+RAW_SAMPLES = 360     # e.g. 3 minutes at a 0.5 s sampling interval
+MINUTE_SAMPLES = 1440  # one day of minute rollups
+HOUR_SAMPLES = 4416   # six months of hour rollups, enough for an irrigation season
+HISTORY_RESOLUTIONS = {u"raw": 0, u"minute": 60, u"hour": 3600}
+
+class FlowRing(object):
+    """
+    Fixed size ring of (time, rate, amount) entries backed by arrays.
+    """
+    def __init__(self, size):
+        self.size = size
+        self.times = array("d", [0.0]) * size
+        self.rates = array("f", [0.0]) * size
+        self.amounts = array("f", [0.0]) * size
+        self.count = 0
+        self.next = 0
+
+    def append(self, t, rate, amount):
+        self.times[self.next] = t
+        self.rates[self.next] = rate
+        self.amounts[self.next] = amount
+        self.next = (self.next + 1) % self.size
+        self.count = min(self.count + 1, self.size)
+
+    def entries(self, start=None, end=None):
+        """
+        Returns [time, rate, amount] lists, oldest first, optionally limited to start <= time < end.
+        """
+        result = []
+        first = (self.next - self.count) % self.size
+        for n in range(self.count):
+            i = (first + n) % self.size
+            t = self.times[i]
+            if (start is None or t >= start) and (end is None or t < end):
+                result.append([t, self.rates[i], self.amounts[i]])
+        return result
+
+class StationHistory(object):
+    """
+    Raw samples of one station plus their minute and hour rollups.
+    """
+    def __init__(self):
+        self.rings = {u"raw": FlowRing(RAW_SAMPLES),
+                      u"minute": FlowRing(MINUTE_SAMPLES),
+                      u"hour": FlowRing(HOUR_SAMPLES)}
+        # open rollup buckets: resolution -> [bucket start, rate*seconds, seconds, amount]
+        self.buckets = {u"minute": None, u"hour": None}
+
+    def add(self, t, rate, amount, elapsed):
+        self.rings[u"raw"].append(t, rate, amount)
+        self._rollup(u"minute", t, rate * elapsed, elapsed, amount)
+
+    def _rollup(self, res, t, rate_secs, secs, amount):
+        period = HISTORY_RESOLUTIONS[res]
+        start = t - t % period
+        bucket = self.buckets[res]
+        if bucket is not None and bucket[0] != start:
+            self._close(res, bucket)
+            bucket = None
+        if bucket is None:
+            bucket = self.buckets[res] = [start, 0.0, 0.0, 0.0]
+        bucket[1] += rate_secs
+        bucket[2] += secs
+        bucket[3] += amount
+
+    def _close(self, res, bucket):
+        start, rate_secs, secs, amount = bucket
+        rate = rate_secs / secs if secs else 0.0
+        self.rings[res].append(start, rate, amount)
+        if res == u"minute":
+            self._rollup(u"hour", start, rate_secs, secs, amount)
+
+    def entries(self, res, start=None, end=None):
+        result = self.rings[res].entries(start, end)
+        bucket = self.buckets.get(res)
+        if bucket is not None and (start is None or bucket[0] >= start) and (end is None or bucket[0] < end):
+            result.append([bucket[0], bucket[1] / bucket[2] if bucket[2] else 0.0, bucket[3]])  # bucket still filling
+        return result
+
+class FlowHistory(object):
+    """
+    Per-station flow history shared by the sampling thread and the web pages.
+    """
+    def __init__(self):
+        self._stations = {}
+        self._lock = Lock()
 
+    def record(self, t, rates, amounts, elapsed):
+        with self._lock:
+            for station, (rate, amount) in enumerate(zip(rates, amounts)):
+                if station not in self._stations:
+                    self._stations[station] = StationHistory()
+                self._stations[station].add(t, rate, amount, elapsed)
+
+    def query(self, station, res=u"minute", start=None, end=None):
+        """
+        Returns [time, rate, amount] entries of one station at the given resolution
+          ("raw", "minute" or "hour"), oldest first.
+        """
+        if res not in HISTORY_RESOLUTIONS:
+            raise ValueError(u"unknown resolution: " + res)
+        with self._lock:
+            if station not in self._stations:
+                return []
+            return self._stations[station].entries(res, start, end)
+
+flow_history = FlowHistory()
 
 # TODO: add support for other types of RPi serial interfaces with different /dev/names
 
-def flow_sensor_loop():
+ #############################################
+ # Binary serial protocol
+ #############################################
+# With the "Binary" serial protocol the Arduino streams its counters without being polled.
+# The host starts the stream by sending "BS<interval in ms>\n"; "RS\n" still resets the
+# counters and restarts the sequence numbers at 0.  Every frame is:
+#
+#   0xA5 0x5A | length (1 byte) | sequence (1 byte) | length bytes of payload | CRC-8
+#
+# The payload is one little endian uint32 pulse counter per sensor, the sequence number
+# wraps at 256 and the CRC-8 (polynomial 0x07) covers length, sequence and payload.
+# A FlowSerialReader thread parses the frames into a shared buffer so update_flow_values
+# only copies the latest counters and never waits on the serial port.
+FRAME_SYNC = bytearray([0xA5, 0x5A])
+FRAME_OVERHEAD = 5  # sync (2) + length + sequence + crc
+
+def _crc8_table():
+    table = []
+    for byte in range(256):
+        crc = byte
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x07) & 0xFF if crc & 0x80 else (crc << 1) & 0xFF
+        table.append(crc)
+    return table
+
+CRC8_TABLE = _crc8_table()
+
+def crc8(data):
+    crc = 0
+    for byte in bytearray(data):
+        crc = CRC8_TABLE[crc ^ byte]
+    return crc
+
+def encode_flow_frame(seq, counters):
+    """
+    Builds a frame for the given sequence number and counters, as the Arduino sends it.
+      Useful for a simulated Arduino on a pty.
+    """
+    payload = bytearray(struct.pack(u"<{}I".format(len(counters)), *[int(c) for c in counters]))
+    body = bytearray([len(payload), seq & 0xFF]) + payload
+    return bytes(FRAME_SYNC + body + bytearray([crc8(body)]))
+
+READER_STOP_TIMEOUT = 2.0  # seconds, longer than the serial port timeout
+
+class FlowSerialReader(Thread):
+    """
+    Reads counter frames from the Arduino as they arrive and keeps the latest counters,
+    plus counts of dropped (sequence gaps) and corrupt (bad CRC) frames.
+    """
+    def __init__(self, serial_ch):
+        Thread.__init__(self)
+        self.daemon = True
+        self.serial_ch = serial_ch
+        self.stopped = False
+        self.counters = []
+        self.seq = None
+        self.frame_time = 0
+        self.frames = 0
+        self.dropped = 0
+        self.corrupt = 0
+        self.interval_ms = None  # stream interval last sent to the Arduino
+        self._waiting_for_reset = False
+        self._baseline = ()
+        self._buf = bytearray()
+        self._lock = Lock()
+
+    def stop(self):
+        """
+        Stops the thread and waits for it to let go of the port, reads time out after 1 s.
+        """
+        self.stopped = True
+        if self.is_alive() and self is not current_thread():
+            self.join(READER_STOP_TIMEOUT)
+
+    def reset(self):
+        """
+        Forgets the current counters.  The next valid frame becomes the baseline the
+          counters are measured from, or zero if it is the Arduino's first frame (sequence 0)
+          after the RS command.  Counters that go down later mean the Arduino restarted
+          them, and the baseline drops back to zero.  A lost or corrupt frame therefore
+          costs at most one sample.
+        """
+        with self._lock:
+            self.counters = []
+            self.seq = None
+            self._waiting_for_reset = True
+
+    def copy_counters(self, vector):
+        """
+        Copies the latest counters into vector in place, missing sensors read as 0.
+        """
+        with self._lock:
+            counters = self.counters
+            for i in range(len(vector)):
+                vector[i] = counters[i] if i < len(counters) else 0.0
+        return vector
+
+    def run(self):
+        while not self.stopped:
+            try:
+                data = self.serial_ch.read(max(1, self.serial_ch.inWaiting()))
+            except Exception as e:
+                log.error(u"serial reader stopped: {}", e)
+                return
+            if data:
+                self._buf.extend(bytearray(data))
+                self._parse()
+
+    def _parse(self):
+        buf = self._buf
+        while True:
+            start = buf.find(FRAME_SYNC)
+            if start < 0:
+                del buf[:-1]  # keep a trailing half sync byte
+                return
+            if start > 0:
+                del buf[:start]
+            if len(buf) < FRAME_OVERHEAD:
+                return
+            length = buf[2]
+            if len(buf) < FRAME_OVERHEAD + length:
+                return
+            body = buf[2:4 + length]
+            if crc8(body) != buf[4 + length]:
+                self.corrupt += 1
+                del buf[:2]  # resync on the next sync pattern
+                continue
+            self._frame(body[1], bytes(body[2:]))
+            del buf[:FRAME_OVERHEAD + length]
+
+    def _frame(self, seq, payload):
+        count = len(payload) // 4
+        counters = struct.unpack(u"<{}I".format(count), payload[:count*4])
+        with self._lock:
+            if self._waiting_for_reset:
+                self._waiting_for_reset = False
+                self._baseline = () if seq == 0 else counters
+            elif any(c < b for c, b in zip(counters, self._baseline)):
+                self._baseline = ()  # the Arduino restarted its counters and its sequence
+            elif self.seq is not None:
+                self.dropped += (seq - self.seq - 1) % 256
+            baseline = self._baseline
+            self.seq = seq
+            self.counters = [c - baseline[i] if i < len(baseline) else c for i, c in enumerate(counters)]
+            self.frame_time = time.time()
+            self.frames += 1
+
+def stop_serial_reader():
+    reader = gv.plugin_data[u"fs"].pop(u"serial_reader", None)
+    if reader is not None:
+        reader.stop()
+        if reader.serial_ch.isOpen():
+            reader.serial_ch.write(u"BS0\n")  # stop the stream, e.g. when switching back to ASCII
+            reader.serial_ch.flush()
+
+def start_serial_reader(serial_ch):
+    """
+    Starts a FlowSerialReader on serial_ch unless one is already reading it and asks the
+      Arduino to stream frames at the active sampling rate.
+    """
+    reader = gv.plugin_data[u"fs"].get(u"serial_reader")
+    if reader is None or reader.serial_ch is not serial_ch or not reader.is_alive():
+        if reader is not None:
+            reader.stop()
+        reader = FlowSerialReader(serial_ch)
+        gv.plugin_data[u"fs"][u"serial_reader"] = reader
+        reader.start()
+    send_stream_interval(reader)
+    return reader
+
+def send_stream_interval(reader):
+    """
+    Sends the active sampling rate to the Arduino when it differs from the one last sent.
+    """
+    interval_ms = int(float(gv.plugin_data[u"fs"][u"settings"][u"active_interval"])*1000)
+    if reader.interval_ms != interval_ms:
+        reader.serial_ch.write(u"BS{}\n".format(interval_ms))
+        reader.serial_ch.flush()
+        reader.interval_ms = interval_ms
+
+ #############################################
+ # RaspberryPi-GPIO interface
+ #############################################
+# Flow sensors wired straight to the Pi are counted with edge callbacks, one pin per
+# station in the order given by the "gpio_pins" setting.  With pigpio the daemon counts
+# the edges itself (callback tally), otherwise RPi.GPIO calls _edge on its event thread.
+# Each pin's count is written only by that thread and reset() just moves a baseline, so
+# counting needs no locks.
+class GPIOPulseCounter(object):
+    """
+    Counts falling edges on a list of pins and reports them like the serial counters.
+    gpio (RPi.GPIO like) or pi (pigpio.pi like) can be mock objects for testing.
+    """
+    def __init__(self, pins, gpio=None, pi=None):
+        self.pins = list(pins)
+        self.gpio = gpio
+        self.pi = pi
+        self.counts = [0]*len(self.pins)
+        self.base = [0]*len(self.pins)
+        self._callbacks = []
+        self._index = {pin: i for i, pin in enumerate(self.pins)}
+
+    def start(self):
+        if self.pi is not None:
+            for pin in self.pins:
+                self.pi.set_mode(pin, 0)  # pigpio.INPUT
+                self.pi.set_pull_up_down(pin, 2)  # pigpio.PUD_UP
+                self._callbacks.append(self.pi.callback(pin, 1))  # pigpio.FALLING_EDGE, counted by tally()
+        else:
+            for pin in self.pins:
+                self.gpio.setup(pin, self.gpio.IN, pull_up_down=self.gpio.PUD_UP)
+                self.gpio.add_event_detect(pin, self.gpio.FALLING, callback=self._edge)
+
+    def stop(self):
+        if self.pi is not None:
+            for cb in self._callbacks:
+                cb.cancel()
+            self._callbacks = []
+        else:
+            for pin in self.pins:
+                self.gpio.remove_event_detect(pin)
+
+    def _edge(self, pin):
+        self.counts[self._index[pin]] += 1
+
+    def _raw_counts(self):
+        if self.pi is not None:
+            return [cb.tally() for cb in self._callbacks]
+        return self.counts
+
+    def reset(self):
+        self.base = list(self._raw_counts())
+
+    def copy_counters(self, vector):
+        """
+        Copies the pulse counts since the last reset into vector in place.
+        """
+        counts = self._raw_counts()
+        for i in range(len(vector)):
+            vector[i] = counts[i] - self.base[i] if i < len(counts) else 0.0
+        return vector
+
+def parse_gpio_pins(text):
+    return [int(pin) for pin in text.replace(u" ", u"").split(u",") if pin]
+
+def start_gpio_counter():
+    """
+    Starts a GPIOPulseCounter on the configured pins unless one is already running on them.
+    """
+    pins = parse_gpio_pins(gv.plugin_data[u"fs"][u"settings"][u"gpio_pins"])
+    counter = gv.plugin_data[u"fs"].get(u"gpio_counter")
+    if counter is not None and counter.pins == pins:
+        return counter
+    stop_gpio_counter()
+    if gv.use_pigpio:
+        from gpio_pins import pi
+        counter = GPIOPulseCounter(pins, pi=pi)
+    else:
+        from gpio_pins import GPIO
+        counter = GPIOPulseCounter(pins, gpio=GPIO)
+    counter.start()
+    gv.plugin_data[u"fs"][u"gpio_counter"] = counter
+    return counter
+
+def stop_gpio_counter():
+    counter = gv.plugin_data[u"fs"].pop(u"gpio_counter", None)
+    if counter is not None:
+        counter.stop()
+
+ #############################################
+ # Leak and burst detection
+ #############################################
+# The detector runs on every sample and only keeps running statistics (Welford mean and
+# variance of each station's flow rate while it is on), so it needs no stored history.
+#  - leak: flow above "leak_rate" while all valves are closed for LEAK_SAMPLES samples
+#  - burst: a running station flowing more than "burst_factor" times its learned baseline
+#    (and 3 standard deviations above it) for BURST_SAMPLES samples
+# Either one sends the alarm_toggled signal used by lcd_adj, telegram_bot and pump_control.
+LEAK_SAMPLES = 3
+BURST_SAMPLES = 3
+BASELINE_MIN_SAMPLES = 30  # samples needed before a baseline is trusted
+SETTLE_TIME = 10.0  # seconds after a valve opens before its flow is checked/learned
+
+alarm = signal(u"alarm_toggled")
+
+class FlowAnomalyDetector(object):
+    """
+    Learns a per-station baseline flow rate and raises alarms for leaks and bursts.
+    """
+    def __init__(self):
+        self.baselines = {}  # station -> [samples, mean, sum of squared deviations]
+        self.opened = {}  # station -> time the valve was seen opening
+        self.leak_samples = 0
+        self.burst_samples = {}
+        self.alarmed = set()  # conditions already reported, cleared when they end
+
+    def load(self, data):
+        self.baselines = {int(station): stats for station, stats in data.items()}
+
+    def dump(self):
+        return {str(station): stats for station, stats in self.baselines.items()}
+
+    def baseline(self, station):
+        """
+        Returns (mean, standard deviation) of the station's rate or None while still learning.
+        """
+        stats = self.baselines.get(station)
+        if stats is None or stats[0] < BASELINE_MIN_SAMPLES:
+            return None
+        return stats[1], (stats[2] / (stats[0] - 1)) ** 0.5
+
+    def learn(self, station, rate):
+        stats = self.baselines.setdefault(station, [0, 0.0, 0.0])
+        stats[0] += 1
+        delta = rate - stats[1]
+        stats[1] += delta / stats[0]
+        stats[2] += delta * (rate - stats[1])
+
+    def check(self, t, rates, srvals):
+        settings = gv.plugin_data[u"fs"][u"settings"]
+        if settings[u"flow_alarms"] != u"on":
+            return
+        units = settings[u"rate_units"]
+        open_stations = [sid for sid, valve in enumerate(srvals[:len(rates)]) if valve]
+        for sid in list(self.opened):
+            if sid not in open_stations:
+                del self.opened[sid]
+                self.burst_samples.pop(sid, None)
+                self.alarmed.discard((u"burst", sid))
+
+        if not open_stations:
+            total = sum(rates)
+            if total > float(settings[u"leak_rate"]):
+                self.leak_samples += 1
+                if self.leak_samples >= LEAK_SAMPLES:
+                    self._raise((u"leak", None), u"Flow of {:.1f} {} while all valves are closed".format(total, units))
+            else:
+                self.leak_samples = 0
+                self.alarmed.discard((u"leak", None))
+            return
+
+        self.leak_samples = 0
+        self.alarmed.discard((u"leak", None))
+        for sid in open_stations:
+            opened = self.opened.setdefault(sid, t)
+            if t - opened < SETTLE_TIME:
+                continue
+            rate = rates[sid]
+            baseline = self.baseline(sid)
+            if baseline is not None:
+                mean, std = baseline
+                if rate > mean * float(settings[u"burst_factor"]) and rate > mean + 3 * std:
+                    self.burst_samples[sid] = self.burst_samples.get(sid, 0) + 1
+                    if self.burst_samples[sid] >= BURST_SAMPLES:
+                        self._raise((u"burst", sid), u"{} flowing {:.1f} {}, expected about {:.1f}".format(
+                            gv.snames[sid] if sid < len(gv.snames) else sid + 1, rate, units, mean))
+                    continue  # keep abnormal samples out of the baseline
+                self.burst_samples[sid] = 0
+                self.alarmed.discard((u"burst", sid))
+            self.learn(sid, rate)
+
+    def _raise(self, condition, txt):
+        if condition in self.alarmed:
+            return
+        self.alarmed.add(condition)
+        log.warning(u"alarm: {}", txt)
+        alarm.send(u"flow_sensors", txt=txt)
+
+flow_detector = FlowAnomalyDetector()
+try:
+    with open(u"./data/flow_baseline.json", u"r") as f:
+        flow_detector.load(json.load(f))
+except (IOError, ValueError):
+    pass
+
+def save_flow_baseline():
+    with open(u"./data/flow_baseline.json", u"w") as f:
+        json.dump(flow_detector.dump(), f)
+
+ #############################################
+ # Water usage ledger
+ #############################################
+# Every station that used water during a program/run-once gets one fixed size record in
+# ./data/flow_ledger.bin when the next run is scheduled: program, station, start time,
+# run time in seconds and litres used.  Records are only ever appended.  The start times
+# and a per-station list of record numbers are kept in memory, so date range and station
+# queries only read the matching records.
+LEDGER_FILE = u"./data/flow_ledger.bin"
+LEDGER_RECORD = struct.Struct(b"<HHdff")  # program, station, start, duration (s), litres
+LEDGER_FIELDS = [u"program", u"station", u"start", u"duration", u"litres"]
+
+class FlowLedger(object):
+    """
+    Append-only binary ledger of water used per program run and station.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.starts = array("d")  # start time of every record, in record order
+        self.stations = {}  # station -> record numbers
+        self._lock = Lock()
+        try:
+            with open(self.path, u"rb") as f:
+                data = f.read()
+        except IOError:
+            data = b""
+        count = len(data) // LEDGER_RECORD.size
+        for n in range(count):
+            program, station, start, duration, litres = LEDGER_RECORD.unpack_from(data, n*LEDGER_RECORD.size)
+            self._index(n, station, start)
+
+    def _index(self, n, station, start):
+        self.starts.append(start)
+        self.stations.setdefault(station, []).append(n)
+
+    def append(self, records):
+        """
+        Appends (program, station, start, duration, litres) tuples, sorted by start time.
+        """
+        records = sorted(records, key=lambda r: r[2])
+        if not records:
+            return
+        with self._lock:
+            n = len(self.starts)
+            with open(self.path, u"ab") as f:
+                for program, station, start, duration, litres in records:
+                    f.write(LEDGER_RECORD.pack(program, station, start, duration, litres))
+                    self._index(n, station, start)
+                    n += 1
+
+    def query(self, start=None, end=None, station=None):
+        """
+        Returns the records with start <= record start < end, optionally only for one station
+          (index starting at 0), as dicts with LEDGER_FIELDS keys.
+        """
+        with self._lock:
+            first = bisect.bisect_left(self.starts, start) if start is not None else 0
+            last = bisect.bisect_left(self.starts, end) if end is not None else len(self.starts)
+            if station is None:
+                numbers = range(first, last)
+            else:
+                numbers = [n for n in self.stations.get(station, []) if first <= n < last]
+            result = []
+            if not numbers:
+                return result
+            with open(self.path, u"rb") as f:
+                for n in numbers:
+                    f.seek(n*LEDGER_RECORD.size)
+                    result.append(dict(zip(LEDGER_FIELDS, LEDGER_RECORD.unpack(f.read(LEDGER_RECORD.size)))))
+            return result
+
+flow_ledger = FlowLedger(LEDGER_FILE)
+
+def ledger_csv(records):
+    """
+    Yields the records as CSV lines with a header.
+    """
+    yield u"Program, Station, Start, Duration, Litres\n"
+    for r in records:
+        yield u"{}, {}, {}, {:.0f}, {:.2f}\n".format(
+            r[u"program"], r[u"station"] + 1,
+            time.strftime(u"%Y-%m-%d %H:%M:%S", time.localtime(r[u"start"])), r[u"duration"], r[u"litres"])
+
+# Held by the sampler while it updates the per-station vectors and by the signal and web
+# threads while they flush the ledger or reset the vectors.
+sample_lock = RLock()
+
+def flush_ledger():
+    """
+    Appends a ledger record for every station that ran since the last flush, with the
+      water used since then, and marks those runs as recorded.
+    Called with sample_lock held when the next program is scheduled, when all valves have
+      closed and when SIP exits.
+    """
+    fs = gv.plugin_data[u"fs"]
+    if u"run_starts" not in fs:
+        return
+    to_litres = LITERS_PER_GALLON if fs[u"settings"][u"units"] == u"Gallons" else 1.0
+    run_starts = fs[u"run_starts"]
+    run_seconds = fs[u"run_seconds"]
+    recorded = fs[u"ledger_amounts"]
+    records = []
+    for sid in range(len(run_starts)):
+        amount = fs[u"program_amounts"][sid] - recorded[sid]
+        if run_starts[sid] and amount > 0:
+            records.append((int(fs[u"run_programs"][sid]), sid, run_starts[sid], run_seconds[sid], amount*to_litres))
+            recorded[sid] = fs[u"program_amounts"][sid]
+        run_starts[sid] = 0
+        run_seconds[sid] = 0
+    flow_ledger.append(records)
+
+def flush_ledger_at_exit():
+    with sample_lock:
+        flush_ledger()
+
+class FlowSampler(Thread):
     """
-    This tread will update the flow sensor values every N seconds.
+    Samples the flow counters at a high rate while any station is on and at a
+    near-idle rate while all valves are closed.  wake() cuts the current wait
+    short, e.g. when a zone changes state, also when it comes while a sample is
+    being taken.
     """
-    delta_t = 3.0 # seconds
-    while True:
-        update_flow_values()
-        time.sleep(delta_t)
+    def __init__(self):
+        Thread.__init__(self)
+        self.daemon = True
+        self.flush_pending = False  # set when all valves closed, the ledger is flushed after the next sample
+        self._sleeper = plugin_services.Sleeper()
+
+    def wake(self):
+        self._sleeper.wake()
+
+    def interval(self):
+        settings = gv.plugin_data[u"fs"][u"settings"]
+        if any(gv.srvals):
+            return float(settings[u"active_interval"])
+        return float(settings[u"idle_interval"])
+
+    def run(self):
+        while True:
+            try:
+                with sample_lock:
+                    update_flow_values()
+                    if self.flush_pending and not any(gv.srvals):
+                        self.flush_pending = False
+                        flush_ledger()
+            except Exception as e:
+                log.error(u"sampling error: {}", e)
+            self._sleeper.sleep(self.interval())
 
 def reset_flow_sensors():
     """
     Resets parameters used by this plugin for all three flow_sensor types.
-    Used at initialization and at the start of each Program/Run-Once 
+    Used at initialization, at the start of each Program/Run-Once and when the interface
+      settings change.
     """
-    print(u"resetting flow sensors")
+    with sample_lock:
+        return _reset_flow_sensors()
+
+def _reset_flow_sensors():
+    log.debug(u"resetting flow sensors")
+    if gv.plugin_data[u"fs"][u"settings"][u"interface"] != u"RaspberryPi-GPIO":
+        stop_gpio_counter()
     gv.plugin_data[u"fs"][u"start_time"] = time.time()
     gv.plugin_data[u"fs"][u"prev_read_time"] = time.time()
-    gv.plugin_data[u"fs"][u"prev_read_cntrs"] = [0]*8
-    gv.plugin_data[u"fs"][u"program_amounts"] = [0]*8
+    allocate_flow_vectors()
+    zero_vector(gv.plugin_data[u"fs"][u"prev_read_cntrs"])
+    zero_vector(gv.plugin_data[u"fs"][u"program_amounts"])
+    zero_vector(gv.plugin_data[u"fs"][u"run_starts"])
+    zero_vector(gv.plugin_data[u"fs"][u"run_seconds"])
+    zero_vector(gv.plugin_data[u"fs"][u"ledger_amounts"])
+    run_programs = gv.plugin_data[u"fs"][u"run_programs"]
+    for sid in range(len(run_programs)):
+        run_programs[sid] = gv.rs[sid][3] if sid < len(gv.rs) else 0  # program about to run each station
 
     if gv.plugin_data[u"fs"][u"settings"][u"interface"] == u"Simulated":
-        gv.plugin_data[u"fs"][u"simulated_counters"] = [0]*8
+        zero_vector(gv.plugin_data[u"fs"][u"simulated_counters"])
         return True
 
     elif gv.plugin_data[u"fs"][u"settings"][u"interface"] == u"Arduino-Serial":
-        serial_ch = serial.Serial(u"/dev/ttyACM0", 9600, timeout=1)
-        gv.plugin_data[u"fs"][u"serial_chan"] = serial_ch
-        time.sleep(0.1)
+        serial_ch = open_serial_channel()
+        if gv.plugin_data[u"fs"][u"settings"][u"serial_protocol"] == u"Binary":
+            reader = start_serial_reader(serial_ch)
+            reader.reset()
+            serial_ch.write(u"RS\n")
+            serial_ch.flush()
+            return True
+        stop_serial_reader()
         serial_ch.write(u"RS\n")
         serial_ch.flush()
-        time.sleep(0.1)
-        line = serial_ch.readline()
-        print(u"values from Arduino on establishing serial port")
-        print(line)
+        line = serial_ch.readline()  # returns as soon as the Arduino answers (or after the port timeout)
+        log.debug(u"values from Arduino on establishing serial port: {}", line)
         return True
 
     elif gv.plugin_data[u"fs"][u"settings"][u"interface"] == u"RaspberryPi-GPIO":
-        pass
+        start_gpio_counter().reset()
         return True
-    print(u"Flow Sensor Type Failed in Reset")
+    log.error(u"Flow Sensor Type Failed in Reset")
     return False
 
+def zero_vector(vector):
+    for i in range(len(vector)):
+        vector[i] = 0.0
+
+def open_serial_channel():
+    """
+    Returns the serial channel to the Arduino, (re)opening it only when the configured port
+      changed.  The port can be a pty so a simulated Arduino can stand in for the real one.
+    """
+    port = gv.plugin_data[u"fs"][u"settings"][u"serial_port"]
+    serial_ch = gv.plugin_data[u"fs"].get(u"serial_chan")
+    if serial_ch is not None and serial_ch.port == port and serial_ch.isOpen():
+        return serial_ch
+    if serial_ch is not None:
+        stop_serial_reader()
+        serial_ch.close()
+    serial_ch = serial.Serial(port, 9600, timeout=1)
+    gv.plugin_data[u"fs"][u"serial_chan"] = serial_ch
+    return serial_ch
+
 def read_flow_counters(reset=False):
     """
-    Reads counters corresponding to each flow sensor.
+    Reads counters corresponding to each flow sensor into the preallocated curr_read_cntrs vector
+      and returns it.
     Supports simulated flow sensors (for testing UI), flow sensors connected to an Arduino and
       perhaps flow sensors connected directly to the Pi.
     """
-    print(u"reading flow sensors")
+    log.debug(u"reading flow sensors")
+    curr_cntrs = gv.plugin_data[u"fs"][u"curr_read_cntrs"]
     if gv.plugin_data[u"fs"][u"settings"][u"interface"] == u"Simulated":
+        counters = gv.plugin_data[u"fs"][u"simulated_counters"]
         if reset:
-            gv.plugin_data[u"fs"][u"simulated_counters"] = [0]*8
+            zero_vector(counters)
         else:
-            current_counters = gv.plugin_data[u"fs"][u"simulated_counters"]
-            new_counters = [count + valve*(random.random()*40 + 180) for valve, count in zip(gv.srvals, current_counters)]
-            gv.plugin_data[u"fs"][u"simulated_counters"] = new_counters
-        return gv.plugin_data[u"fs"][u"simulated_counters"]
+            for i, valve in enumerate(gv.srvals[:len(counters)]):
+                if valve:
+                    counters[i] += random.random()*40 + 180
+        curr_cntrs[:] = counters
+        return curr_cntrs
 
     elif gv.plugin_data[u"fs"][u"settings"][u"interface"] == u"Arduino-Serial":
+        reader = gv.plugin_data[u"fs"].get(u"serial_reader")
+        if reader is not None and not reader.stopped:
+            if not reader.is_alive():
+                log.error(u"serial reader thread stopped, restarting it")
+                reader = start_serial_reader(gv.plugin_data[u"fs"][u"serial_chan"])
+            if not reader.frames:
+                return curr_cntrs  # no frame from the new reader yet, keep the last counters
+            return reader.copy_counters(curr_cntrs)  # latest streamed frame, never blocks
         serial_ch = gv.plugin_data[u"fs"][u"serial_chan"]
         if reset:
             serial_ch.write(u"RS\n")
         else:
             serial_ch.write(u"RD\n")
         serial_ch.flush()
-        print(u"Writing to Arduino")
-        time.sleep(0.2)
-        line = serial_ch.readline().rstrip()
-        print(u"serial input from Arduino is: " + line)
-        print(u"serial input has been printed")
-        if line == u"":
-            return [0]*8
-        else:
-            vals = map(int, line.split(u","))
-        return vals
+        line = serial_ch.readline().rstrip()  # no fixed delay, the frame is read as soon as it arrives
+        log.debug(u"serial input from Arduino is: {}", line)
+        zero_vector(curr_cntrs)
+        if line != u"":
+            for i, val in enumerate(line.split(u",")[:len(curr_cntrs)]):
+                curr_cntrs[i] = int(val)
+        return curr_cntrs
 
     elif gv.plugin_data[u"fs"][u"settings"][u"interface"] == u"RaspberryPi-GPIO":
-        pass
-        return [0]*8
+        return start_gpio_counter().copy_counters(curr_cntrs)
 
-    print(u"Flow Sensor Type Failed in Read")
+    log.error(u"Flow Sensor Type Failed in Read")
     return False
 
 def update_flow_values():
     """
     Updates gv values for the current flow rate and accumulated flow amount for each flow sensors.
+    All vectors are preallocated by allocate_flow_vectors and updated in place.
     """
-    pulses_per_liter = gv.plugin_data[u"fs"][u"settings"][u"pulses_per_liter"]
-    units = gv.plugin_data[u"fs"][u"settings"][u"units"]
     current_time = time.time()
 
     elapsed_prev_read = current_time - gv.plugin_data[u"fs"][u"prev_read_time"]  # for flow rate
-    print(u"elapsed time: " + str(elapsed_prev_read))
+    log.debug(u"elapsed time: {}", elapsed_prev_read)
 
     prev_cntrs = gv.plugin_data[u"fs"][u"prev_read_cntrs"]
 
     curr_cntrs = read_flow_counters()
 
-    # calculate flow amount in Liters as # of pulses * liters_per_pulse
-    #  or #_of_pulses / (pulses_per_liter)
+    rates = gv.plugin_data[u"fs"][u"rates"]
+    if not any(gv.srvals) and curr_cntrs == prev_cntrs:
+        # all valves closed and no pulses since the last sample, nothing to recompute
+        zero_vector(rates)
+        flow_detector.check(current_time, rates, gv.srvals)
+        gv.plugin_data[u"fs"][u"prev_read_time"] = current_time
+        return
 
-    amt_conv_mult = 1.0/pulses_per_liter  # or liters per pulse
-    if u"units" == u"Gallons":
-        amt_conv_mult /= 3.78541
+    # flow amount = # of pulses * amt_conv_mult (units per pulse)
+    # flow rate in units per hour = pulses_per_second * rate_conv_mult (seconds_per_hour * units_per_pulse)
+    amt_conv_mult = gv.plugin_data[u"fs"][u"amt_conv_mult"]
+    rate_mult = gv.plugin_data[u"fs"][u"rate_conv_mult"]/elapsed_prev_read
+    amounts = gv.plugin_data[u"fs"][u"program_amounts"]
+    deltas = gv.plugin_data[u"fs"][u"amount_deltas"]
+    for i in range(len(curr_cntrs)):
+        pulses = curr_cntrs[i] - prev_cntrs[i]
+        amounts[i] = curr_cntrs[i]*amt_conv_mult
+        deltas[i] = pulses*amt_conv_mult
+        rates[i] = pulses*rate_mult
 
-    gv.plugin_data[u"fs"][u"program_amounts"] = [cntr*amt_conv_mult for cntr in curr_cntrs]
+    run_starts = gv.plugin_data[u"fs"][u"run_starts"]
+    run_seconds = gv.plugin_data[u"fs"][u"run_seconds"]
+    for i, valve in enumerate(gv.srvals[:len(run_starts)]):
+        if valve:
+            if not run_starts[i]:
+                run_starts[i] = current_time
+            run_seconds[i] += elapsed_prev_read
 
-    # calculate flow rate in Liters per hour = pulses_per_second * (seconds_per_hour * liters_per_pulse)
-    rate_conv_mult = 60.*60./pulses_per_liter
-    if u"units" == u"Gallons":
-        rate_conv_mult /= 3.78541
+    flow_history.record(current_time, rates, deltas, elapsed_prev_read)
+    flow_detector.check(current_time, rates, gv.srvals)
 
-    gv.plugin_data[u"fs"][u"rates"] = [(cntr-prev_cntr)*rate_conv_mult/elapsed_prev_read for \
-                                     cntr, prev_cntr in zip(curr_cntrs, prev_cntrs)]
-    
-    print(u"Rates:" + str(["%0.2f" % val for val in gv.plugin_data[u"fs"][u"rates"]]))
-    print(u"Amounts:" + str(["%0.2f" % val for val in gv.plugin_data[u"fs"][u"program_amounts"]]))
+    log.debug(u"Rates: {}", rates.tolist())
+    log.debug(u"Amounts: {}", amounts.tolist())
 
     gv.plugin_data[u"fs"][u"prev_read_time"] = current_time
-    gv.plugin_data[u"fs"][u"prev_read_cntrs"] = curr_cntrs
-   
+    prev_cntrs[:] = curr_cntrs
+
 ### Stations where sheduled to run ###
 # gets triggered when:
 #       - A program is run (Scheduled or "run now")
@@ -205,19 +1006,37 @@ def update_flow_values():
 def notify_station_scheduled(name, **kw):
     """
     Subscribes to the stations_scheduled signal and used to reset the flow_sensor counters
-      and flow rate/amount values in the gv.
+      and flow rate/amount values in the gv.  Water used by the previous run that is not
+      in the ledger yet is recorded first.
+    """
+    with sample_lock:
+        flush_ledger()
+        reset_flow_sensors()
+    save_flow_baseline()
+    log.info(u"Some stations have been scheduled: {}", gv.rs)
+
+### valves ###
+def notify_zone_change(name, **kw):
+    """
+    Subscribes to the zone_change signal so the sampler switches between its active and
+      idle rates right away instead of at the end of the current wait.  Once all valves
+      are closed the sampler takes a last sample and records the runs in the ledger.
     """
-    reset_flow_sensors()
-    print(u"Some stations have been scheduled: {}".format(str(gv.rs)))
+    if not any(gv.srvals):
+        fs_loop.flush_pending = True
+    fs_loop.wake()
 
 reset_flow_sensors()
-fs_loop = Thread(target=flow_sensor_loop)
-fs_loop.daemon = True
+fs_loop = FlowSampler()
 fs_loop.start()
+atexit.register(flush_ledger_at_exit)
 
 program_started = signal(u"stations_scheduled") # subscribe to signal when programs/stations start running
 program_started.connect(notify_station_scheduled) # specify callback for this signal
 
+zones = signal(u"zone_change")
+zones.connect(notify_zone_change)
+
  #############################################
  # Web Interface for plugin settings
  #############################################
@@ -228,17 +1047,16 @@ class settings(ProtectedPage):
     
     def GET(self):
         settings = gv.plugin_data[u"fs"][u"settings"]
-        print(u"settings are:  " + str(settings))
-        print (u"GET method in settings class")
         try:
             with open(u"./data/flow_sensors.json", u"r") as f:  # Read settings from json file if it exists
-                settings = json.load(f)
-                reset_flow_sensors()
+                settings.update(json.load(f))
         except IOError:  # If file does not exist return empty value
-            print(u"No flow_sensors.json file")
-            print(u"my settings here are: " + str(settings))
+            log.debug(u"No flow_sensors.json file")
         return template_render.flow_sensors(settings)  # open settings page
 
+# Settings that change where the counters come from, the counters are reset when they change
+INTERFACE_SETTINGS = [u"interface", u"serial_port", u"serial_protocol", u"gpio_pins"]
+
 class save_settings(ProtectedPage):
     """
     Save user input to json file.
@@ -248,18 +1066,84 @@ class save_settings(ProtectedPage):
     def GET(self):
         settings = gv.plugin_data[u"fs"][u"settings"]
         qdict = web.input()  # Dictionary of values returned as query string from settings page.
-        print(u"qdict = " + str(qdict))  # for testing
-        print(u"settings : " + str(settings))
+        log.debug(u"qdict = {}", qdict)  # for testing
+        interface = [settings[key] for key in INTERFACE_SETTINGS]
         for key in qdict:
             # watch out for checkboxes since they only return a value in qdict if they're checked!!
-            if key == u"pulses_per_liter":
+            if key in [u"pulses_per_liter", u"active_interval", u"idle_interval", u"leak_rate", u"burst_factor"]:
                 settings[key] = float(qdict[key])
             else:
                 settings[key] = qdict[key]
+        if u"flow_alarms" not in qdict:
+            settings[u"flow_alarms"] = u"off"
         fixPerHour()
-        reset_flow_sensors()
-        print(u"after update from qdict, settings = " + str(settings))
+        if [settings[key] for key in INTERFACE_SETTINGS] != interface:
+            reset_flow_sensors()  # a run in progress keeps its amounts unless the counters change
+        reader = gv.plugin_data[u"fs"].get(u"serial_reader")
+        if reader is not None and not reader.stopped:
+            with sample_lock:
+                send_stream_interval(reader)  # the active interval may have changed
+        fs_loop.wake()
+        log.debug(u"after update from qdict, settings = {}", settings)
         with open(u"./data/flow_sensors.json", u"w") as f:  # Edit: change name of json file
              json.dump(settings, f) # save to file
-             print(u"flow sensor settings file saved")          
+             log.info(u"flow sensor settings file saved")
         raise web.seeother(u"/")  # Return user to home page.
+
+class history(ProtectedPage):
+    """
+    Returns the flow history in JSON format.
+    Query parameters (all optional):
+      station - station number starting at 1, all stations if omitted
+      res - "raw", "minute" (default) or "hour"
+      start, end - unix timestamps limiting the returned entries
+    Each entry is [time, rate, amount] in the units selected in the settings.
+    """
+    def GET(self):
+        qdict = web.input(station=None, res=u"minute", start=None, end=None)
+        web.header(u"Access-Control-Allow-Origin", u"*")
+        web.header(u"Content-Type", u"application/json")
+        try:
+            start = float(qdict.start) if qdict.start else None
+            end = float(qdict.end) if qdict.end else None
+            if qdict.station:
+                stations = [int(qdict.station) - 1]
+                if not 0 <= stations[0] < station_count():
+                    raise ValueError(u"no station {}".format(qdict.station))
+            else:
+                stations = range(station_count())
+            data = {str(sid + 1): flow_history.query(sid, qdict.res, start, end) for sid in stations}
+        except ValueError as e:
+            return json.dumps({u"error": str(e)})
+        return json.dumps({u"units": gv.plugin_data[u"fs"][u"settings"][u"units"],
+                           u"rate_units": gv.plugin_data[u"fs"][u"settings"][u"rate_units"],
+                           u"resolution": qdict.res,
+                           u"stations": data})
+
+class ledger(ProtectedPage):
+    """
+    Returns water usage ledger records as CSV (default) or JSON.
+    Query parameters (all optional):
+      station - station number starting at 1, all stations if omitted
+      start, end - unix timestamps limiting the run start times
+      format - "csv" or "json"
+    """
+    def GET(self):
+        qdict = web.input(station=None, start=None, end=None, format=u"csv")
+        records = flow_ledger.query(float(qdict.start) if qdict.start else None,
+                                    float(qdict.end) if qdict.end else None,
+                                    int(qdict.station) - 1 if qdict.station else None)
+        if qdict.format == u"json":
+            web.header(u"Content-Type", u"application/json")
+            return json.dumps(records)
+        web.header(u"Content-Type", u"text/csv")
+        web.header(u"Content-Disposition", u"attachment; filename=\"flow_ledger.csv\"")
+        return u"".join(ledger_csv(records))
+
+class debug_log(ProtectedPage):
+    """
+    Returns the plugin's recent log messages, including debug messages, as text.
+    """
+    def GET(self):
+        web.header(u"Content-Type", u"text/plain")
+        return log.dump()
@@ -15,6 +15,7 @@ import gv  # Get access to ospi's settings
 from urls import urls  # Get access to sip's URLs
 from ospi import template_render
 from webpages import ProtectedPage
+from plugins import plugin_services
 from helpers import uptime, get_ip, get_cpu_temp, get_rpi_revision
 from blinker import signal
 
@@ -36,13 +37,13 @@ class LCDSender(Thread):
     def __init__(self):
         Thread.__init__(self)
         self.daemon = True
-        self.start()
         self.status = ''
         self.alarm_mode = False
         self.schedule_mode = False
         self._display = ['name']
-        self._sleep_time = 0
+        self._sleeper = plugin_services.Sleeper()
         self._lcd = Lock()
+        self.start()
 
     def _lcd_print(self, report, txt=None):
         self._lcd.acquire()
@@ -189,13 +190,10 @@ class LCDSender(Thread):
         for key in lcd_opts.keys() :
             if key.startswith('d_') and lcd_opts[key] == 'on':
                 self._display.append(key)
-        self._sleep_time = 0
+        self._sleeper.wake()
 
     def _sleep(self, secs):
-        self._sleep_time = secs
-        while self._sleep_time > 0:
-            time.sleep(1)
-            self._sleep_time -= 1
+        self._sleeper.sleep(secs)
 
     def alarm(self, name,  **kw):
         datalcd = get_lcd_options()
@@ -267,8 +265,7 @@ def get_lcd_options():
         'status': checker.status
     }
     try:
-        with open('./data/lcd_adj.json', 'r') as f:  # Read the settings from file
-            file_data = json.load(f)
+        file_data = plugin_services.settings.load('./data/lcd_adj.json')  # Read the settings from file
         for key, value in file_data.iteritems():
             if key in datalcd:
                 datalcd[key] = value
@@ -322,7 +319,6 @@ class update(ProtectedPage):
             else:
                 datalcd[k] = 'off'
 
-        with open('./data/lcd_adj.json', 'w') as f:  # write the settings to file
-            json.dump(datalcd, f)
+        plugin_services.settings.save('./data/lcd_adj.json', datalcd)  # write the settings to file
         checker.update()
         raise web.seeother('/')
@@ -2,6 +2,16 @@
 from __future__ import print_function
 """ SIP plugin adds an MQTT client to SIP for other plugins to broadcast and receive via MQTT
 The intent is to facilitate joining SIP to larger automation systems
+
+publish() never blocks the caller: messages go to a bounded queue that a publisher thread
+sends.  The publisher thread also connects to the broker, retrying with a growing delay.
+While the broker is unreachable QoS 1 and 2 messages are spooled to SPOOL_FILE and sent
+after the connection is back, QoS 0 messages are dropped.  When the queue is full the
+oldest queued message is dropped, publish() does no file I/O on the caller's thread.
+
+Subscriptions may use the + and # wildcards.  Callbacks run on paho's network thread
+unless subscribed with worker=True, then they run on a dispatch worker so a slow
+callback does not hold up other topics.
 """
 __author__ = "Daniel Casner <daniel@danielcasner.org>"
 
@@ -12,6 +22,13 @@ from sip import template_render  #  Needed for working with web.py templates
 from webpages import ProtectedPage  # Needed for security
 import json  # for working with data file
 import atexit # For publishing down message
+import os
+import time
+from threading import Thread, Event, Lock
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 try:
     import paho.mqtt.client as mqtt
 except ImportError:
@@ -20,6 +37,12 @@ except ImportError:
     mqtt = None
 
 DATA_FILE = "./data/mqtt.json"
+SPOOL_FILE = "./data/mqtt_spool.json"
+QUEUE_SIZE = 1000       # messages waiting for the publisher thread
+SPOOL_SIZE = 10000      # messages kept on disk while disconnected
+RECONNECT_MIN = 1       # seconds, doubled after every failed connect
+RECONNECT_MAX = 300
+DISPATCH_WORKERS = 2    # threads running callbacks subscribed with worker=True
 
 _client = None
 _settings = {
@@ -27,7 +50,6 @@ _settings = {
     'broker_port': 1883,
     'publish_up_down': ''
 }
-_subscriptions = {}
 
 # Add new URLs to access classes in this plugin.
 urls.extend([
@@ -64,6 +86,7 @@ class save_settings(ProtectedPage):
                 return template_render.proto(qdict, gv.sd[u'name'], "Broker port must be a valid integer port number")
             else:
                 json.dump(_settings, f) # save to file
+                _publisher.reconnect()
                 publish_status()
         raise web.seeother('/')  # Return user to home page.
 
@@ -81,58 +104,279 @@ def get_settings():
         print("MQTT Plugin couldn't open data file:", e)
     return _settings
 
+class TopicTrie(object):
+    """Subscribed topic filters by level, matching a topic costs O(topic depth).
+    A + level matches any one level, a final # matches the parent and all levels below.
+    Topics starting with $ are not matched by wildcards in the first level."""
+
+    def __init__(self):
+        self._root = ({}, [])  # (children by level, callbacks)
+        self._lock = Lock()
+
+    def add(self, topic_filter, callback, worker=False):
+        """Returns True when the filter is new."""
+        with self._lock:
+            node = self._root
+            for level in topic_filter.split('/'):
+                node = node[0].setdefault(level, ({}, []))
+            node[1].append((callback, worker))
+            return len(node[1]) == 1
+
+    def match(self, topic):
+        """Returns the (callback, worker) pairs of all filters matching the topic."""
+        levels = topic.split('/')
+        found = []
+        with self._lock:
+            nodes = [self._root]
+            for depth, level in enumerate(levels):
+                wildcards = depth > 0 or not level.startswith('$')
+                next_nodes = []
+                for children, callbacks in nodes:
+                    if wildcards and '#' in children:
+                        found.extend(children['#'][1])
+                    if level in children:
+                        next_nodes.append(children[level])
+                    if wildcards and '+' in children:
+                        next_nodes.append(children['+'])
+                nodes = next_nodes
+                if not nodes:
+                    break
+            for children, callbacks in nodes:
+                found.extend(callbacks)
+                if '#' in children:
+                    found.extend(children['#'][1])
+        return found
+
+class Dispatcher(object):
+    """Runs callbacks on worker threads.  All messages of one callback go to the same
+    worker so they are handled in the order received."""
+
+    def __init__(self, workers):
+        self._queues = [queue.Queue() for i in range(workers)]
+        self._threads = []
+
+    def submit(self, callback, client, msg):
+        if not self._threads:
+            for q in self._queues:
+                t = Thread(target=self._run, args=(q,))
+                t.daemon = True
+                t.start()
+                self._threads.append(t)
+        self._queues[hash(callback) % len(self._queues)].put((callback, client, msg))
+
+    def _run(self, q):
+        while True:
+            callback, client, msg = q.get()
+            try:
+                callback(client, msg)
+            except Exception as e:
+                print("MQTT plugin callback failed on topic", msg.topic, e)
+
+_subscriptions = TopicTrie()
+_dispatcher = Dispatcher(DISPATCH_WORKERS)
+
 def on_message(client, userdata, msg):
     "Callback for MQTT data recieved"
-    global _subscriptions
-    if not msg.topic in _subscriptions:
+    callbacks = _subscriptions.match(msg.topic)
+    if not callbacks:
         print("MQTT plugin got unexpected message on topic:", msg.topic)
-    else:
-        for cb in _subscriptions[msg.topic]:
+    for cb, worker in callbacks:
+        if worker:
+            _dispatcher.submit(cb, client, msg)
+        else:
             cb(client, msg)
 
-def get_client():
-    global _client
-    if _client is None and mqtt is not None:
+def on_connect(client, userdata, flags, rc):
+    "Callback for a (re)connection to the broker, runs on paho's network thread"
+    if rc == 0:
+        for topic, qos in _subscription_qos.items():
+            client.subscribe(topic, qos)
+        _connected.set()
+        _publisher.wake()  # send what was spooled meanwhile
+
+def on_disconnect(client, userdata, rc):
+    _connected.clear()
+
+class Publisher(Thread):
+    """Connects to the broker and sends the queued messages."""
+
+    _WAKE = object()
+
+    def __init__(self):
+        Thread.__init__(self)
+        self.daemon = True
+        self._queue = queue.Queue(QUEUE_SIZE)
+        self._spool_lock = Lock()
+        self._spooled = None  # number of spooled messages, None = not counted yet
+        self.dropped = 0
+        self._reconnect = False
+
+    def publish(self, topic, payload, qos=0, retain=False):
+        while True:
+            try:
+                self._queue.put_nowait((topic, payload, qos, retain))
+                return
+            except queue.Full:
+                try:
+                    self._queue.get_nowait()  # make room by dropping the oldest message
+                    self.dropped += 1
+                except queue.Empty:
+                    pass
+
+    def wake(self):
+        try:
+            self._queue.put_nowait(self._WAKE)
+        except queue.Full:
+            pass  # the publisher is busy anyway
+
+    def reconnect(self):
+        """Connect again with the current settings."""
+        self._reconnect = True
+        self.wake()
+
+    def _offline(self, topic, payload, qos, retain):
+        if qos < 1:
+            self.dropped += 1
+            return
+        with self._spool_lock:
+            if self._spooled is None:
+                try:
+                    with open(SPOOL_FILE, 'r') as f:
+                        self._spooled = sum(1 for line in f)
+                except IOError:
+                    self._spooled = 0
+            if self._spooled >= SPOOL_SIZE:
+                self.dropped += 1
+                return
+            with open(SPOOL_FILE, 'a') as f:
+                f.write(json.dumps({'topic': topic, 'payload': payload, 'qos': qos, 'retain': retain}) + '\n')
+            self._spooled += 1
+
+    def _replay(self, client):
+        with self._spool_lock:
+            if self._spooled == 0:
+                return
+            try:
+                with open(SPOOL_FILE, 'r') as f:
+                    lines = f.readlines()
+                os.remove(SPOOL_FILE)
+            except (IOError, OSError):
+                lines = []
+            self._spooled = 0
+        for line in lines:
+            try:
+                m = json.loads(line)
+            except ValueError:
+                continue
+            client.publish(m['topic'], m['payload'], qos=m['qos'], retain=m['retain'])
+
+    def _connect(self):
+        global _client
+        if _client is not None:
+            disconnect()
+        client = mqtt.Client(gv.sd[u'name']) # Use system name as client ID
+        client.on_message = on_message
+        client.on_connect = on_connect
+        client.on_disconnect = on_disconnect
+        if _settings['publish_up_down']:
+            client.will_set(_settings['publish_up_down'], json.dumps("DIED"), qos=1, retain=True)
+        client.connect(_settings['broker_host'], _settings['broker_port'])
+        client.loop_start()  # paho reconnects by itself after this first connection
+        _client = client
+
+    def _next(self, timeout=None):
         try:
-            _client = mqtt.Client(gv.sd[u'name']) # Use system name as client ID
-            _client.on_message = on_message
-            _client.connect(_settings['broker_host'], _settings['broker_port'])
-            if _settings['publish_up_down']:
-                _client.will_set(_settings['publish_up_down'], json.dumps("DIED"), qos=1, retain=True)
-            _client.loop_start()
-        except Exception as e:
-            print("MQTT plugin couldn't initalize client:", e)
-    return _client
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return self._WAKE
+
+    def run(self):
+        delay = RECONNECT_MIN
+        next_attempt = 0  # no connect before this time, whatever wakes the loop
+        while True:
+            if self._reconnect:
+                self._reconnect = False
+                next_attempt = 0  # new settings are tried at once
+                delay = RECONNECT_MIN
+                if _client is not None:
+                    disconnect()
+            now = time.time()
+            if _client is None and now >= next_attempt:
+                try:
+                    self._connect()
+                    delay = RECONNECT_MIN
+                except Exception as e:
+                    print("MQTT plugin couldn't connect to the broker:", e)
+                    next_attempt = now + delay
+                    delay = min(delay * 2, RECONNECT_MAX)
+            if _connected.is_set():
+                wait = None
+            elif _client is None:
+                wait = max(next_attempt - time.time(), 0)
+            else:
+                wait = 1  # connected, waiting for on_connect
+
+            if _connected.is_set():
+                self._replay(_client)
+            message = self._next(wait)
+            if message is self._WAKE:
+                continue
+            if _connected.is_set():
+                try:
+                    _client.publish(message[0], message[1], qos=message[2], retain=message[3])
+                except Exception as e:
+                    print("MQTT plugin couldn't publish on", message[0], e)
+            else:
+                self._offline(*message)
+
+_publisher = Publisher()
+_connected = Event()
+_subscription_qos = {}
+
+def get_client():
+    """Returns the shared client while it is connected, else None.
+    Connecting happens on the publisher thread, this never waits for the broker."""
+    return _client if _connected.is_set() else None
+
+def publish(topic, payload, qos=0, retain=False):
+    "Queues a message for publishing and returns at once"
+    if mqtt is not None:
+        _publisher.publish(topic, payload, qos, retain)
 
 def publish_status(status="UP"):
     global _settings
     if _settings['publish_up_down']:
         print("MQTT publish", status)
+        publish(_settings['publish_up_down'], json.dumps(status), qos=1, retain=True)
+
+def subscribe(topic, callback, qos=0, worker=False):
+    """Subscribes to a topic, which may contain + and # wildcards, with the given callback.
+    With worker=True the callback runs on a dispatch worker instead of the network thread."""
+    if _subscriptions.add(topic, callback, worker):
+        _subscription_qos[topic] = qos
         client = get_client()
         if client:
-            client.publish(_settings['publish_up_down'], json.dumps(status), qos=1, retain=True)
-
-def subscribe(topic, callback, qos=0):
-    "Subscribes to a topic with the given callback"
-    global _subscriptions
-    client = get_client()
-    if client:
-        if topic not in _subscriptions:
-            _subscriptions[topic] = [callback]
-            client.subscribe(topic, qos)
-        else:
-            _subscriptions[topic].append(callback)
+            client.subscribe(topic, qos)  # otherwise on_connect subscribes
 
-def on_restart():
+def disconnect():
     global _client
     if _client is not None:
-        publish_status("DOWN")
         _client.disconnect()
         _client.loop_stop()
         _client = None
+        _connected.clear()
+
+def on_restart():
+    if _client is not None and _connected.is_set():
+        if _settings['publish_up_down']:
+            _client.publish(_settings['publish_up_down'], json.dumps("DOWN"), qos=1, retain=True)
+    disconnect()
 
 atexit.register(on_restart)
 
 get_settings()
 
+if mqtt is not None:
+    _publisher.start()
+
 publish_status()
@@ -1,6 +1,20 @@
 # !/usr/bin/env python
 from __future__ import print_function
 """ SIP plugin uses mqtt plugin to receive run once program commands over MQTT
+
+A command is one of
+    [10, 0, 30, ...]                      durations in seconds by station number
+    {"Front lawn": 60, "Roses": 30}      durations by station name
+    {"station": "Roses", "duration": 30} one station by name or number (starting at 1)
+and a message is a command or a batch {"id": "...", "commands": [command, ...]}.
+Only the stations given a duration are (re)scheduled.  SIP's schedule_stations() retimes
+every station with a duration in sequential mode, so while a sequence is running the
+stations are queued after it here instead and the running stations keep their times,
+skipping the stations that do not ignore rain while rain delay or the rain sensor is on.
+Retained messages are ignored, they would run the stations again on every reconnect.
+A batch whose id was accepted in the last DEDUP_WINDOW seconds is ignored so redelivered
+messages do not start the stations again.  A message without an id is ignored when the
+same payload was accepted in the last CONTENT_DEDUP_WINDOW seconds.
 """
 __author__ = "Daniel Casner <daniel@danielcasner.org>"
 
@@ -12,8 +26,16 @@ from webpages import ProtectedPage  # Needed for security
 from blinker import signal # To receive station notifications
 from helpers import schedule_stations
 import json  # for working with data file
+import time
+import hashlib
+from collections import OrderedDict
+from threading import Lock
 from plugins import mqtt
 
+DEDUP_WINDOW = 600  # seconds a message id is remembered
+CONTENT_DEDUP_WINDOW = 30  # seconds the payload of a message without an id is remembered
+DEDUP_SIZE = 1000  # most message ids and payloads remembered
+
 # Add new URLs to access classes in this plugin.
 urls.extend([
     '/mr1-sp', 'plugins.mqtt_schedule.settings',
@@ -43,59 +65,145 @@ class save_settings(ProtectedPage):
         subscribe()
         raise web.seeother('/')  # Return user to home page.
 
+_station_index = None  # station name -> station index, rebuilt when names change
+_seen = OrderedDict()  # message id -> time received
+_seen_content = OrderedDict()  # payload hash -> time received
+_lock = Lock()
+
+def index_station_names(name=None, **kw):
+    "Rebuilds the station name index, connected to the station_names signal"
+    global _station_index
+    _station_index = None
+
+def station_index(station, num_sta):
+    "Returns the index of a station given by name or number (starting at 1), or None"
+    global _station_index
+    if _station_index is None:
+        _station_index = {sname: i for i, sname in enumerate(gv.snames)}
+    if station in _station_index:
+        return _station_index[station]
+    if not isinstance(station, bool) and isinstance(station, int) and 1 <= station <= num_sta:
+        return station - 1
+    return None
+
+def valid_duration(v):
+    return isinstance(v, (int, float)) and not isinstance(v, bool) and v >= 0
+
+def is_duplicate(seen, key, window):
+    "True if a valid message with this key was received within window seconds"
+    now = time.time()
+    while seen and next(iter(seen.values())) < now - window:
+        seen.popitem(last=False)
+    return key in seen
+
+def remember(seen, key):
+    "Records a valid message, forgetting the oldest beyond DEDUP_SIZE"
+    seen.pop(key, None)
+    seen[key] = time.time()
+    while len(seen) > DEDUP_SIZE:
+        seen.popitem(last=False)
+
+def parse_command(cmd, num_sta, durations):
+    "Adds the station durations of one command to durations, returns False if it is invalid"
+    if type(cmd) is list:
+        if len(cmd) > num_sta:
+            print("MQTT schedule, too many stations specified, truncating to {}".format(num_sta))
+        for i, v in enumerate(cmd[0:num_sta]):
+            if not valid_duration(v):
+                print("MQTT schedule, invalid duration for station {}:".format(i + 1), v)
+                return False
+            if v:
+                durations[i] = v
+    elif type(cmd) is dict and 'station' in cmd:
+        i = station_index(cmd['station'], num_sta)
+        if i is None or not valid_duration(cmd.get('duration')):
+            print("MQTT schedule, invalid station command:", cmd)
+            return False
+        durations[i] = cmd['duration']
+    elif type(cmd) is dict:
+        for k, v in cmd.items():
+            i = station_index(k, num_sta)
+            if i is None:
+                print("MQTT schedule, no station named:", k)
+            elif not valid_duration(v):
+                print("MQTT schedule, invalid duration for station {}:".format(k), v)
+                return False
+            elif v:
+                durations[i] = v
+    else:
+        print("MQTT schedule unexpected command: ", cmd)
+        return False
+    return True
+
+def run_stations(durations, num_sta):
+    """Schedules the stations in durations (index -> seconds), leaving the others as they are.
+    In sequential mode with stations already running the new stations are timed after the
+    last scheduled one, schedule_stations() would restart the running stations.  Rain is
+    handled and stations_scheduled sent as schedule_stations() does."""
+    gv.ps.extend([0, 0] for i in range(len(gv.ps), num_sta))
+    gv.rs.extend([0, 0, 0, 0] for i in range(len(gv.rs), num_sta))
+    gv.rovals.extend(0 for i in range(len(gv.rovals), num_sta))
+    queue = gv.sd['seq'] and gv.sd['bsy']
+    if queue:
+        rain = gv.sd['rd'] or (gv.sd['urs'] and gv.sd['rs'])
+        accumulate_time = max([gv.now] + [gv.rs[i][1] + gv.sd['sdt'] for i in range(num_sta)
+                                          if gv.rs[i][2] and i not in durations])
+    stations = [0] * (num_sta // 8)
+    for i in sorted(durations):
+        v = durations[i]
+        gv.rovals[i] = v
+        if queue and rain and not gv.sd['ir'][i // 8] & 1 << (i % 8):
+            continue  # rain stops the station, as in schedule_stations()
+        gv.ps[i] = [98, v]
+        if queue:
+            gv.rs[i] = [accumulate_time, accumulate_time + v, v, 98]
+            accumulate_time += v + gv.sd['sdt']
+        else:
+            gv.rs[i] = [gv.now, 0, v, 98]
+            stations[i // 8] += 2 ** (i % 8)
+    if not queue:
+        schedule_stations(stations)
+    else:
+        signal('stations_scheduled').send(u"mqtt_schedule")
+
 def on_message(client, msg):
     "Callback when MQTT message is received."
     if not gv.sd['en']: # check operation status
         return
-    num_brds = gv.sd['nbrd']
-    num_sta  = num_brds * 8
+    if getattr(msg, 'retain', False):
+        print("MQTT schedule, ignoring retained message")
+        return
+    num_sta = gv.sd['nbrd'] * 8
     try:
         cmd = json.loads(msg.payload)
     except ValueError as e:
         print("MQTT Schedule could not decode command: ", msg.payload, e)
         return
-    if type(cmd) is list:
-        if len(cmd) < num_sta:
-            print("MQTT schedule, not enough stations specified, assuming first {} of {}".format(len(cmd), num_sta))
-            rovals = cmd + ([0] * (num_sta - len(cmd)))
-        elif len(cmd) > num_sta:
-            print("MQTT schedule, too many stations specified, truncating to {}".format(num_sta))
-            rovals = cmd[0:num_sta]
+    with _lock:
+        if type(cmd) is dict and 'id' in cmd:
+            seen, key, window = _seen, str(cmd['id']), DEDUP_WINDOW
         else:
-            rovals = cmd
-    elif type(cmd) is dict:
-        rovals = [0] * num_sta
-        for k, v in cmd.items():
-            if k not in gv.snames:
-                print("MQTT schedule, no station named:", k)
-            else:
-                rovals[gv.snames.index(k)] = v
-    else:
-        print("MQTT schedule unexpected command: ", msg.payload)
-        return
-    if any(rovals):
-        print("MQTT schedule:", rovals)
-        gv.rovals = rovals
-        stations = [0] * num_brds
-        gv.ps = []  # program schedule (for display)
-        gv.rs = []  # run schedule
-        for i in range(gv.sd['nst']):
-            gv.ps.append([0, 0])
-            gv.rs.append([0, 0, 0, 0])
-        for i, v in enumerate(gv.rovals):
-            if v:  # if this element has a value
-                gv.rs[i][0] = gv.now
-                gv.rs[i][2] = v
-                gv.rs[i][3] = 98
-                gv.ps[i][0] = 98
-                gv.ps[i][1] = v
-                stations[i / 8] += 2 ** (i % 8)
-        schedule_stations(stations)
+            payload = msg.payload if isinstance(msg.payload, bytes) else msg.payload.encode('utf-8')
+            seen, key, window = _seen_content, hashlib.sha1(payload).hexdigest(), CONTENT_DEDUP_WINDOW
+        if is_duplicate(seen, key, window):
+            print("MQTT schedule, ignoring repeated message")
+            return
+        durations = {}
+        commands = cmd['commands'] if type(cmd) is dict and 'commands' in cmd else [cmd]
+        if type(commands) is not list or not all(parse_command(c, num_sta, durations) for c in commands):
+            return  # nothing is run, so a corrected message may reuse the id
+        remember(seen, key)
+        if durations:
+            print("MQTT schedule:", durations)
+            run_stations(durations, num_sta)
+
+station_names = signal('station_names')
+station_names.connect(index_station_names)
 
 def subscribe():
     "Subscribe to messages"
     topic = mqtt.get_settings().get('schedule_topic')
     if topic:
-        mqtt.subscribe(topic, on_message, 2)
+        mqtt.subscribe(topic, on_message, 2, worker=True)  # scheduling must not hold up the network thread
 
 subscribe()
@@ -0,0 +1,197 @@
+# !/usr/bin/env python
+from __future__ import print_function
+""" SIP plugin uses mqtt plugin to publish sensor readings of other plugins as telemetry.
+Every sample interval the flow rates (flow_sensors), pump pressure and status (pump_control)
+and ADC inputs (pcf_8591_adj) are read from the values those plugins already keep, a
+source whose plugin is not loaded is skipped.  A numeric reading is kept when it moved by
+at least the deadband of its source since it was last published, other readings when they
+changed, and every reading again after the heartbeat interval.  The kept readings are
+published together every publish interval, one message per source:
+    {"time": <publish time>, "readings": [[<sample time>, <name>, <value>], ...]}
+on the telemetry topic, where {name} is replaced by the system name and {source} by
+flow, pump or pcf.
+"""
+
+import web  # web.py framework
+import gv  # Get access to SIP's settings
+import sys
+import time
+from urls import urls  # Get access to SIP's URLs
+from sip import template_render  #  Needed for working with web.py templates
+from webpages import ProtectedPage  # Needed for security
+import json  # for working with data file
+from threading import Thread, Lock
+from plugins import mqtt
+from plugins import plugin_services
+
+SOURCES = ('flow', 'pump', 'pcf')
+DEFAULTS = {
+    'telemetry_topic': '{name}/telemetry/{source}',
+    'telemetry_sample': 5,        # seconds between samples
+    'telemetry_publish': 30,      # seconds between published batches
+    'telemetry_heartbeat': 600,   # seconds after which unchanged readings are published again
+    'telemetry_deadband_flow': 1.0,
+    'telemetry_deadband_pump': 0.1,
+    'telemetry_deadband_pcf': 2,
+}
+
+# Add new URLs to access classes in this plugin.
+urls.extend([
+    '/telemetry2mqtt-sp', 'plugins.mqtt_telemetry.settings',
+    '/telemetry2mqtt-save', 'plugins.mqtt_telemetry.save_settings'
+    ])
+gv.plugin_menu.append(['MQTT telemetry', '/telemetry2mqtt-sp'])
+
+def get_telemetry_settings():
+    "The telemetry settings from the mqtt data file, with defaults for missing keys"
+    settings = mqtt.get_settings()
+    return dict((key, settings.get(key, default)) for key, default in DEFAULTS.items())
+
+class settings(ProtectedPage):
+    """Load an html page for entering plugin settings.
+    """
+    def GET(self):
+        return template_render.mqtt_telemetry(get_telemetry_settings(), "")  # open settings page
+
+class save_settings(ProtectedPage):
+    """Save user input to json file.
+    Will create or update file when SUBMIT button is clicked
+    """
+    def GET(self):
+        qdict = web.input()  # Dictionary of values returned as query string from settings page.
+        values = {'telemetry_topic': qdict.get('telemetry_topic', '')}
+        try:
+            for key in DEFAULTS:
+                if key != 'telemetry_topic':
+                    values[key] = float(qdict[key])
+                    assert values[key] >= 0
+            assert values['telemetry_sample'] > 0
+        except (KeyError, ValueError, AssertionError):
+            return template_render.mqtt_telemetry(dict(get_telemetry_settings(), **qdict),
+                                                  "Intervals and deadbands must be positive numbers")
+        settings = mqtt.get_settings()
+        settings.update(values)
+        with open(mqtt.DATA_FILE, 'w') as f:
+            json.dump(settings, f) # save to file
+        bridge.update()
+        raise web.seeother('/')  # Return user to home page.
+
+def loaded_plugin(name):
+    "The module of another plugin if SIP loaded it, the bridge does not load plugins itself"
+    return sys.modules.get('plugins.' + name)
+
+def sample_flow():
+    "Flow rate of every station and their total, None without flow_sensors"
+    fs = gv.plugin_data.get(u"fs")
+    if not fs or u"rates" not in fs:
+        return None
+    rates = list(fs[u"rates"])
+    values = dict(('rate_%d' % (sid + 1), round(rate, 3)) for sid, rate in enumerate(rates))
+    values['rate'] = round(sum(rates), 3)
+    return time.time(), values
+
+def sample_pump():
+    "Last pressure and pump status sampled by pump_control, None before its first sample"
+    pump_control = loaded_plugin('pump_control')
+    if pump_control is None:
+        return None
+    values = pump_control.live.get()
+    if not values['sampled']:
+        return None
+    readings = {'status': values['pump_status_val']}
+    try:
+        readings['pressure'] = float(values['pressure_val'])
+    except (TypeError, ValueError):
+        pass
+    return values['sampled'], readings
+
+def sample_pcf():
+    "Last ADC inputs sampled by pcf_8591_adj, None before its first sample"
+    pcf = loaded_plugin('pcf_8591_adj')
+    if pcf is None:
+        return None
+    values = pcf.live.get()
+    if not values['sampled']:
+        return None
+    return values['sampled'], dict(('ad%d' % ch, values['ad%dval' % ch]) for ch in range(4))
+
+SAMPLERS = {'flow': sample_flow, 'pump': sample_pump, 'pcf': sample_pcf}
+
+def is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+class TelemetryBridge(Thread):
+    """Samples the sources, applies the deadbands and publishes the batched readings."""
+
+    def __init__(self):
+        Thread.__init__(self)
+        self.daemon = True
+        self._sleeper = plugin_services.Sleeper()
+        self._lock = Lock()
+        self._settings = None     # loaded on the thread, None = reload
+        self._last_sample = {}    # source -> time of the last sample taken
+        self._published = {}      # (source, name) -> (time, value) last published
+        self._batches = dict((source, []) for source in SOURCES)
+        self.start()
+
+    def update(self):
+        """Reload the settings and publish every reading again."""
+        with self._lock:
+            self._settings = None
+        self._sleeper.wake()
+
+    def sample(self, settings):
+        for source in SOURCES:
+            try:
+                sample = SAMPLERS[source]()
+            except Exception as e:
+                print("MQTT telemetry could not sample", source + ":", e)
+                continue
+            if sample is None or sample[0] == self._last_sample.get(source):
+                continue  # no new sample since the last one
+            t, values = sample
+            self._last_sample[source] = t
+            deadband = settings['telemetry_deadband_' + source]
+            for name in sorted(values):
+                value = values[name]
+                last = self._published.get((source, name))
+                if last is not None and t - last[0] < settings['telemetry_heartbeat']:
+                    if is_number(value) and is_number(last[1]):
+                        if abs(value - last[1]) < deadband:
+                            continue
+                    elif value == last[1]:
+                        continue
+                self._published[(source, name)] = (t, value)
+                self._batches[source].append([round(t, 1), name, value])
+
+    def publish(self, settings):
+        now = time.time()
+        for source in SOURCES:
+            readings = self._batches[source]
+            if not readings:
+                continue
+            self._batches[source] = []
+            topic = settings['telemetry_topic'].replace('{name}', gv.sd[u'name']).replace('{source}', source)
+            mqtt.publish(topic, json.dumps({'time': round(now, 1), 'readings': readings}, separators=(',', ':')))
+
+    def run(self):
+        next_publish = 0
+        while True:
+            with self._lock:
+                if self._settings is None:
+                    self._settings = get_telemetry_settings()
+                    self._published = {}
+                settings = self._settings
+            if not settings['telemetry_topic']:
+                self._sleeper.sleep(3600)  # disabled until the settings are saved
+                continue
+            try:
+                self.sample(settings)
+                if time.time() >= next_publish:
+                    self.publish(settings)
+                    next_publish = time.time() + settings['telemetry_publish']
+            except Exception as e:
+                print("MQTT telemetry error:", e)
+            self._sleeper.sleep(float(settings['telemetry_sample']))
+
+bridge = TelemetryBridge()
@@ -1,6 +1,9 @@
 # !/usr/bin/env python
 from __future__ import print_function
 """ SIP plugin uses mqtt plugin to broadcast station status every time it changes.
+Changes arriving within COALESCE_WINDOW are published together: each changed zone on its
+own retained subtopic (<zone topic>/<station number>, <zone topic>/master) and one retained
+full snapshot on the zone topic for late subscribers.
 """
 __author__ = "Daniel Casner <daniel@danielcasner.org>"
 
@@ -11,8 +14,11 @@ from sip import template_render  #  Needed for working with web.py templates
 from webpages import ProtectedPage  # Needed for security
 from blinker import signal # To receive station notifications
 import json  # for working with data file
+from threading import Lock, Timer
 from plugins import mqtt
 
+COALESCE_WINDOW = 0.25  # seconds zone changes are collected before publishing
+
 # Add new URLs to access classes in this plugin.
 urls.extend([
     '/zone2mqtt-sp', 'plugins.mqtt_zones.settings',
@@ -39,23 +45,68 @@ class save_settings(ProtectedPage):
         settings.update(qdict)
         with open(mqtt.DATA_FILE, 'w') as f:
             json.dump(settings, f) # save to file
+        publisher.reset()
         raise web.seeother('/')  # Return user to home page.
 
+class ZonePublisher(object):
+    """Coalesces zone_change signals and publishes only the zones that changed."""
+
+    def __init__(self):
+        self._lock = Lock()
+        self._flush_lock = Lock()  # one flush at a time, a slow publish can overlap the next window
+        self._timer = None
+        self._zone_topic = None  # cached from the mqtt settings, None = not loaded
+        self._published = {}     # subtopic -> payload last published
+
+    def reset(self):
+        """Reload the settings and publish every zone again on the next change."""
+        with self._lock:
+            self._zone_topic = None
+            self._published = {}
+
+    def notify(self):
+        with self._lock:
+            if self._timer is None:
+                self._timer = Timer(COALESCE_WINDOW, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self):
+        with self._lock:
+            self._timer = None
+            if self._zone_topic is None:
+                self._zone_topic = mqtt.get_settings().get('zone_topic', '')
+            zone_topic = self._zone_topic
+        if not zone_topic:
+            return
+
+        with self._flush_lock:
+            names = gv.snames
+            mas = gv.sd['mas']
+            vals = list(gv.srvals)
+            master_on = 0 if mas == 0 else vals[mas-1]
+            zones = [(zone_topic + '/' + str(sid + 1), json.dumps({'name': name, 'state': status}))
+                     for sid, (name, status) in enumerate(zip(names, vals))]
+            zones.append((zone_topic + '/master', json.dumps(master_on)))
+            changed = [(topic, payload) for topic, payload in zones if self._published.get(topic) != payload]
+            if not changed:
+                return
+
+            for topic, payload in changed:
+                mqtt.publish(topic, payload, qos=1, retain=True)
+                self._published[topic] = payload
+            snapshot = {
+                'zone_list': vals,
+                'zone_dict': {name: status for name, status in zip(names, vals)},
+                'master_on': master_on
+            }
+            mqtt.publish(zone_topic, json.dumps(snapshot), qos=1, retain=True)
+
+publisher = ZonePublisher()
+
 ### valves ###
 def notify_zone_change(name, **kw):
-    names = gv.snames
-    mas = gv.sd['mas']
-    vals = gv.srvals
-    payload = {
-        'zone_list': vals,
-        'zone_dict': {name: status for name, status in zip(names, vals)},
-        'master_on': 0 if mas == 0 else vals[mas-1]
-    }
-    zone_topic = mqtt.get_settings().get('zone_topic')
-    if zone_topic:
-        client = mqtt.get_client()
-        if client:
-            client.publish(zone_topic, json.dumps(payload), qos=1, retain=True)
+    publisher.notify()
 
 zones = signal('zone_change')
 zones.connect(notify_zone_change)
@@ -1,19 +1,25 @@
 #!/usr/bin/env python
 # This plugin read data (temp or voltage) from I2C PCF8591 on adress 0x48. For temperature probe use LM35D. Power for PCF8591 or LM35D is 5V dc! no 3.3V dc
 
-from threading import Thread
+from threading import Thread, Lock
 from random import randint
+from collections import namedtuple
+import calendar
 import json
 import time
+import os
 import sys
 import traceback
+import atexit
 
 import web
 import gv  # Get access to ospi's settings
 from urls import urls  # Get access to ospi's URLs
 from ospi import template_render
 from webpages import ProtectedPage
+from plugins import plugin_services
 from helpers import get_rpi_revision
+from blinker import signal
 
 # I2C bus Rev Raspi RPI=1 rev1 RPI=0 rev0 
 try:
@@ -22,9 +28,27 @@ try:
 except ImportError:
     ADC = None
 
+IDLE_CHECK = 3600     # seconds between settings checks when nothing is scheduled
+MAX_OVERSAMPLE = 7    # readings averaged per channel, 1 + 4 * 7 bytes fit one SMBus block read
+
+# Last values read from the inputs, shown on the page and in the JSON settings
+live = plugin_services.LiveValues(ad0val=0, ad1val=0, ad2val=0, ad3val=0)
+
+# Logged values: time, AD0, AD1, AD2, AD3
+data_log = plugin_services.SegmentedLog('./data/pcf_log', 'ffff')
+
+# Rollup resolutions: seconds per bucket and number of buckets kept
+ROLLUP_RESOLUTIONS = {
+    'minute': (60, 24 * 60),
+    'hour': (3600, 31 * 24),
+    'day': (24 * 3600, 366)
+}
+ROLLUP_FILE = './data/pcf_rollups.json'
+
 # Add a new url to open the data entry page.
 urls.extend(['/pcf', 'plugins.pcf_8591_adj.settings',
              '/pcfj', 'plugins.pcf_8591_adj.settings_json',
+             '/pcfq', 'plugins.pcf_8591_adj.rollups',
              '/pcfa', 'plugins.pcf_8591_adj.update',
              '/pcfl', 'plugins.pcf_8591_adj.pcf_log',
              '/pcfr', 'plugins.pcf_8591_adj.delete_log'])
@@ -41,10 +65,11 @@ class PCFSender(Thread):
     def __init__(self):
         Thread.__init__(self)
         self.daemon = True
-        self.start()
         self.status = ''
-
-        self._sleep_time = 0
+        self._dac = None            # value last written to the D/A output
+        self._sample_all = False    # set by zone changes
+        self._sleeper = plugin_services.Sleeper()
+        self.start()
 
     def add_status(self, msg):
         if self.status:
@@ -54,30 +79,44 @@ class PCFSender(Thread):
         print msg
 
     def update(self):
-        self._sleep_time = 0
+        self._sample_all = True     # restart the schedules with the new intervals
+        self._sleeper.wake()
+
+    def notify_zone_change(self, name, **kw):
+        """Sample all inputs right away when stations switch on or off."""
+        self._sample_all = True
+        self._sleeper.wake()
 
     def _sleep(self, secs):
-        self._sleep_time = secs
-        while self._sleep_time > 0:
-            time.sleep(1)
-            self._sleep_time -= 1
+        self._sleeper.sleep(secs)
 
     def run(self):
         time.sleep(randint(3, 10))  # Sleep some time to prevent printing before startup information
         print "PCF8591 plugin is active"
         last_time = gv.now
+        next_sample = [0] * 4                                        # time each input is due
 
         while True:
             try:
                 datapcf = get_pcf_options()                          # load data from file
+                wait = IDLE_CHECK
                 if datapcf['use_pcf'] != 'off':                      # if pcf plugin is enabled
+                    now = time.time()
+                    if self._sample_all:
+                        self._sample_all = False
+                        due = range(4)
+                    else:
+                        due = [ch for ch in range(4) if now >= next_sample[ch]]
+                    if due:
+                        sample_inputs(datapcf['oversample'], due)    # one block read for all due inputs
+                        for ch in due:
+                            next_sample[ch] = now + sample_interval(datapcf, ch)
+                    wait = min(wait, min(next_sample) - now)
                     if datapcf['use_log'] != 'off' and datapcf['time'] != '0':  # if log is enabled and time is not 0 min
                         actual_time = gv.now
                         if actual_time - last_time > (int(datapcf['time']) * 60):       # if is time for save
-                            ad0 = get_now_measure(1)
-                            ad1 = get_now_measure(2)
-                            ad2 = get_now_measure(3)
-                            ad3 = get_now_measure(4)
+                            sample = sample_inputs(datapcf['oversample'])
+                            ad0, ad1, ad2, ad3 = sample.ad0, sample.ad1, sample.ad2, sample.ad3
                             if datapcf['ad0'] != 'off': 
                                ad0 = get_volt(ad0)
                             else:
@@ -103,20 +142,27 @@ class PCFSender(Thread):
                                    ' AD3=' + str(ad3)
                             self.add_status(TEXT)
                             write_log(ad0, ad1, ad2, ad3)
+                        wait = min(wait, last_time + int(datapcf['time']) * 60 - actual_time + 1)
                 
-                out_val = datapcf['da0val']  
-                get_write_DA(int(out_val)) # send to DA 0 output value 0-255 -> 0-5V 
+                out_val = int(datapcf['da0val'])
+                if out_val != self._dac:                             # only write changed values
+                    get_write_DA(out_val) # send to DA 0 output value 0-255 -> 0-5V 
+                    self._dac = out_val
                
-                self._sleep(1)
+                self._sleep(max(1, wait))
                
             except Exception:
                 exc_type, exc_value, exc_traceback = sys.exc_info()
                 err_string = ''.join(traceback.format_exception(exc_type, exc_value, exc_traceback))
                 self.add_status('PCF plugin encountered error: ' + err_string)
+                self._dac = None
                 self._sleep(5)
 
 checker = PCFSender()
 
+zone_change = signal('zone_change')
+zone_change.connect(checker.notify_zone_change)
+
 ################################################################################
 # Helper functions:                                                            #
 ################################################################################
@@ -127,34 +173,145 @@ def get_volt(data):
     volt = round(volt,1)
     return volt
 
+def sample_interval(datapcf, ch):
+    """Seconds between samples of an input, 0 = only when logging and on zone changes"""
+    interval = int(datapcf['ad%dint' % ch])
+    return interval if interval > 0 else float('inf')
+
 def get_temp(data):
     """Return temperature 0-100C from data"""
     temp = ((data*5.0)/255)*100.0
     temp = round(temp,1)
     return temp
 
-def get_now_measure(AD_pin):
-    """Return number 0-255 from A/D PCF8591 to webpage"""
+PCFSample = namedtuple('PCFSample', 'time ad0 ad1 ad2 ad3')
+
+
+class PCF8591(object):
+    """PCF8591 A/D and D/A converter on an SMBus.
+    bus is an smbus.SMBus or any object with the same read_i2c_block_data() and
+    write_byte_data() methods, None when there is no I2C bus (all readings are 0)."""
+
+    CONTROL_DAC = 0x40       # analog output enable
+    CONTROL_AUTO_INC = 0x04  # channel auto-increment
+
+    def __init__(self, bus, address=0x48):
+        self.bus = bus
+        self.address = address
+
+    def read_all(self, oversample=1):
+        """Read the four inputs in one block transaction and return a PCFSample.
+        The chip returns the previous conversion on the first byte, so it is dropped.
+        With oversample > 1 each channel is read that many times and averaged."""
+        oversample = max(1, min(MAX_OVERSAMPLE, int(oversample)))
+        if self.bus is None:
+            return PCFSample(time.time(), 0, 0, 0, 0)
+        data = self.bus.read_i2c_block_data(self.address, self.CONTROL_DAC | self.CONTROL_AUTO_INC,
+                                            1 + 4 * oversample)[1:]
+        if oversample == 1:
+            return PCFSample(time.time(), *data)
+        return PCFSample(time.time(), *[round(float(sum(data[ch::4])) / oversample, 1) for ch in range(4)])
+
+    def write_dac(self, value):
+        if self.bus is not None:
+            self.bus.write_byte_data(self.address, self.CONTROL_DAC, value)
+
+
+adc = PCF8591(ADC)
+
+class PCFRollups(object):
+    """Per channel count, min, max and sum of the raw readings for every minute, hour and
+    day, stored as [counts, mins, maxs, sums] with one entry per channel because the inputs
+    are sampled on their own schedules.  The buckets are updated with each sample, so
+    queries never rescan the log.
+    Raw readings are kept because the volt and temperature conversions are linear, the
+    current conversion of a channel is applied when querying."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = Lock()
+        self.buckets = dict((res, {}) for res in ROLLUP_RESOLUTIONS)
+        try:
+            with open(path, 'r') as f:
+                for res, buckets in json.load(f).iteritems():
+                    if res in self.buckets:
+                        self.buckets[res] = dict((int(start), b) for start, b in buckets.iteritems())
+        except (IOError, ValueError):
+            pass
+
+    def add(self, t, values):
+        """Add one sample (the four raw readings, None for inputs not sampled) taken at time t."""
+        hour_started = False
+        with self._lock:
+            for res, (step, keep) in ROLLUP_RESOLUTIONS.iteritems():
+                start = int(t // step * step)
+                bucket = self.buckets[res].get(start)
+                if bucket is None:
+                    bucket = self.buckets[res][start] = [[0] * 4, [None] * 4, [None] * 4, [0.0] * 4]
+                    for old in [key for key in self.buckets[res] if key <= start - step * keep]:
+                        del self.buckets[res][old]
+                    hour_started = hour_started or res == 'hour'
+                for ch, value in enumerate(values):
+                    if value is None:
+                        continue
+                    bucket[0][ch] += 1
+                    bucket[1][ch] = value if bucket[0][ch] == 1 else min(bucket[1][ch], value)
+                    bucket[2][ch] = value if bucket[0][ch] == 1 else max(bucket[2][ch], value)
+                    bucket[3][ch] += value
+        if hour_started:
+            self.save()
+
+    def query(self, res, start=None, end=None):
+        """Returns the (bucket start, [count, mins, maxs, sums]) of a resolution, oldest first."""
+        with self._lock:
+            return [(key, [list(b[0]), list(b[1]), list(b[2]), list(b[3])])
+                    for key, b in sorted(self.buckets[res].iteritems())
+                    if (start is None or key >= start) and (end is None or key <= end)]
+
+    def clear(self):
+        with self._lock:
+            self.buckets = dict((res, {}) for res in ROLLUP_RESOLUTIONS)
+        self.save()
+
+    def save(self):
+        with self._lock:
+            data = json.dumps(self.buckets)
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(data)
+        os.rename(tmp, self.path)
+
+
+def save_rollups():
+    """Save the rollups when SIP stops, they are otherwise saved once an hour."""
     try:
-        ADC.write_byte_data(0x48, (0x40 + AD_pin), AD_pin)
-        return ADC.read_byte(0x48)
-    except AttributeError:
-        return '0' 
+        rollups_store.save()
+    except (IOError, OSError) as e:
+        print 'PCF rollups could not be saved: ' + str(e)
+
+
+rollups_store = PCFRollups(ROLLUP_FILE)
+atexit.register(save_rollups)
+
+def sample_inputs(oversample=1, channels=range(4)):
+    """Read the inputs, store the ones in channels as live values and add them to the rollups"""
+    sample = adc.read_all(oversample)
+    live.set(**dict(('ad%dval' % ch, sample[1 + ch]) for ch in channels))
+    rollups_store.add(gv.now, [sample[1 + ch] if ch in channels else None for ch in range(4)])
+    return sample
 
 def get_write_DA(Y):  # PCF8591 D/A converter Y=(0-255) for future use
     """Write analog voltage to output"""
-    try:
-        ADC.write_byte_data(0x48, 0x40, Y)
-    except AttributeError:
-        return '0'
+    adc.write_dac(Y)
 
 def get_pcf_options():
-    """Returns the data form file."""
+    """Returns the data form file, without touching the I2C bus."""
     datapcf = {
         'use_pcf': 'off',
         'use_log': 'off',
         'time': '0',
         'records': '0',
+        'days': '0',
         'ad0': 'off',
         'ad1': 'off',
         'ad2': 'off',
@@ -163,16 +320,16 @@ def get_pcf_options():
         'ad1text': 'label_2',
         'ad2text': 'label_3',
         'ad3text': 'label_4',
-        'ad0val': get_now_measure(1),
-        'ad1val': get_now_measure(2),
-        'ad2val': get_now_measure(3),
-        'ad3val': get_now_measure(4),
+        'oversample': '1',
+        'ad0int': '60',
+        'ad1int': '60',
+        'ad2int': '60',
+        'ad3int': '60',
         'da0val': '0', 
         'status': checker.status
     }
     try:
-        with open('./data/pcf_adj.json', 'r') as f:  # Read the settings from file
-            file_data = json.load(f)
+        file_data = plugin_services.settings.load('./data/pcf_adj.json')  # Read the settings from file
         for key, value in file_data.iteritems():
             if key in datapcf:
                 datapcf[key] = value
@@ -182,6 +339,7 @@ def get_pcf_options():
             'use_log': 'off',
             'time': '0',
             'records': '0',
+            'days': '0',
             'ad0': 'off',
             'ad1': 'off',
             'ad2': 'off',
@@ -190,16 +348,16 @@ def get_pcf_options():
             'ad1text': 'label_2',
             'ad2text': 'label_3',
             'ad3text': 'label_4',
-            'ad0val': 0,
-            'ad1val': 0,
-            'ad2val': 0,
-            'ad3val': 0,
+            'oversample': '1',
+            'ad0int': '60',
+            'ad1int': '60',
+            'ad2int': '60',
+            'ad3int': '60',
             'da0val': 0, 
             'status': ''
         }
     
-        with open('./data/pcf_adj.json', 'w') as f:  # write defalult settings to file
-            json.dump(defaultpcf, f) 
+        plugin_services.settings.save('./data/pcf_adj.json', defaultpcf)  # write defalult settings to file
     
     except Exception:
         pass
@@ -207,29 +365,44 @@ def get_pcf_options():
     return datapcf
 
 
-def read_log():
-    """Read pcf log"""
+def get_pcf_values():
+    """Returns the settings together with the last sampled input values."""
+    datapcf = live.get()
+    datapcf.update(get_pcf_options())
+    return datapcf
+
+
+def set_log_limits():
+    datapcf = get_pcf_options()
+    data_log.max_records = int(datapcf['records'])
+    data_log.max_age = int(datapcf['days']) * 24 * 3600
+
+
+def write_log(ad0, ad1, ad2, ad3):
+    """Append run data to the log."""
+    set_log_limits()
+    data_log.append(gv.now, ad0, ad1, ad2, ad3)
+    return
+
+
+def import_json_log():
+    """Move the records of the pcflog.json file of older versions to the log."""
     try:
         with open('./data/pcflog.json') as logf:
             records = logf.readlines()
-        return records
     except IOError:
-        return []
-
+        return
+    for r in reversed(records):  # oldest first
+        try:
+            event = json.loads(r)
+            t = calendar.timegm(time.strptime(event["Date"] + " " + event["Time"], '%d-%m-%Y %H:%M:%S'))
+            data_log.append(t, float(event["AD0"]), float(event["AD1"]), float(event["AD2"]), float(event["AD3"]))
+        except (ValueError, KeyError):
+            continue
+    os.rename('./data/pcflog.json', './data/pcflog.json.bak')
 
-def write_log(ad0, ad1, ad2, ad3):
-    """Add run data to csv file - most recent first."""
-    datapcf = get_pcf_options()
-    logline = '{"Time":"' + time.strftime('%H:%M:%S","Date":"%d-%m-%Y"', time.gmtime(gv.now)) + ',"AD0":"' + str(
-        ad0) + '","AD1":"' + str(ad1) + '","AD2":"' + str(ad2) + '","AD3":"' + str(ad3) + '"}\n'
-    log = read_log()
-    log.insert(0, logline)
-    with open('./data/pcflog.json', 'w') as f:
-        if int(datapcf['records']) != 0:
-            f.writelines(log[:int(datapcf['records'])])
-        else:
-            f.writelines(log)
-    return
+import_json_log()
+set_log_limits()
 
 ################################################################################
 # Web pages:                                                                   #
@@ -240,7 +413,7 @@ class settings(ProtectedPage):
     """Load an html page for entering lcd adjustments."""
 
     def GET(self):
-        return template_render.pcf_8591_adj(get_pcf_options())
+        return template_render.pcf_8591_adj(get_pcf_values())
 
 
 class settings_json(ProtectedPage):
@@ -249,7 +422,40 @@ class settings_json(ProtectedPage):
     def GET(self):
         web.header('Access-Control-Allow-Origin', '*')
         web.header('Content-Type', 'application/json')
-        return json.dumps(get_pcf_options())
+        return json.dumps(get_pcf_values())
+
+
+class rollups(ProtectedPage):
+    """Returns per channel min, max and mean of the readings per minute, hour or day as JSON.
+    Query parameters (all optional):
+      res - "minute", "hour" (default) or "day"
+      start, end - time range, unix timestamps or YYYY-MM-DD[ HH:MM] dates
+    Every channel has a list of [bucket start, min, max, mean, samples] in volt or C.
+    """
+
+    def GET(self):
+        qdict = web.input(res='hour', start=None, end=None)
+        if qdict.res not in ROLLUP_RESOLUTIONS:
+            raise web.badrequest()
+        try:
+            buckets = rollups_store.query(qdict.res, plugin_services.parse_log_time(qdict.start),
+                                          plugin_services.parse_log_time(qdict.end))
+        except ValueError:
+            raise web.badrequest()
+        datapcf = get_pcf_options()
+        channels = {}
+        for ch in range(4):
+            key = 'ad%d' % ch
+            convert = get_volt if datapcf[key] != 'off' else get_temp
+            channels[key] = {
+                'label': datapcf[key + 'text'],
+                'unit': 'V' if datapcf[key] != 'off' else 'C',
+                'data': [[start, convert(b[1][ch]), convert(b[2][ch]), convert(b[3][ch] / b[0][ch]), b[0][ch]]
+                         for start, b in buckets if b[0][ch]]
+            }
+        web.header('Access-Control-Allow-Origin', '*')
+        web.header('Content-Type', 'application/json')
+        return json.dumps({'res': qdict.res, 'step': ROLLUP_RESOLUTIONS[qdict.res][0], 'channels': channels})
 
 
 class update(ProtectedPage):
@@ -269,24 +475,51 @@ class update(ProtectedPage):
             qdict['ad2'] = 'off'
         if 'ad3' not in qdict:
             qdict['ad3'] = 'off'
-        with open('./data/pcf_adj.json', 'w') as f:  # write the settings to file
-            json.dump(qdict, f)
+        plugin_services.settings.save('./data/pcf_adj.json', qdict)  # write the settings to file
         checker.update()
         raise web.seeother('/')
 
 
+def log_csv(records):
+    """Yields the records as CSV lines with a header."""
+    yield "Date, Time, AD0, AD1, AD2, AD3\n"
+    for r in records:
+        yield time.strftime('%d-%m-%Y, %H:%M:%S', time.gmtime(r[0])) + ", " + str(round(r[1], 1)) + ", " + str(
+            round(r[2], 1)) + ", " + str(round(r[3], 1)) + ", " + str(round(r[4], 1)) + ", " + "\n"
+
+
+def log_ndjson(records):
+    """Yields the records as JSON lines, in the format of the older pcflog.json file."""
+    for r in records:
+        yield json.dumps({"Date": time.strftime('%d-%m-%Y', time.gmtime(r[0])),
+                          "Time": time.strftime('%H:%M:%S', time.gmtime(r[0])),
+                          "AD0": round(r[1], 1), "AD1": round(r[2], 1),
+                          "AD2": round(r[3], 1), "AD3": round(r[4], 1)}) + "\n"
+
+
 class pcf_log(ProtectedPage):  # save log file from web as csv file type
-    """Simple PCF Log API"""
+    """Simple PCF Log API, streamed most recent first.
+    Query parameters (all optional):
+      start, end - time range, unix timestamps or YYYY-MM-DD[ HH:MM] dates
+      step - seconds, the records of each step are averaged into one
+      format - "csv" or "ndjson"
+    """
 
     def GET(self):
-        records = read_log()
-        data = "Date, Time, AD0, AD1, AD2, AD3\n"
-        for r in records:
-            event = json.loads(r)
-            data += event["Date"] + ", " + event["Time"] + ", " + str(event["AD0"]) + ", " + str(
-                event["AD1"]) + ", " + str(event["AD2"]) + ", " + str(event["AD3"]) + ", " + "\n"
+        qdict = web.input(start=None, end=None, step=None, format='csv')
+        try:
+            records = data_log.reverse(plugin_services.parse_log_time(qdict.start),
+                                       plugin_services.parse_log_time(qdict.end))
+            step = int(qdict.step) if qdict.step else 0
+        except ValueError:
+            raise web.badrequest()
+        if step > 0:
+            records = plugin_services.downsample(records, step)
+        if qdict.format == 'ndjson':
+            web.header('Content-Type', 'application/x-ndjson')
+            return plugin_services.chunked(log_ndjson(records))
         web.header('Content-Type', 'text/csv')
-        return data
+        return plugin_services.chunked(log_csv(records))
 
 
 class delete_log(ProtectedPage):  # delete log file from web
@@ -294,8 +527,8 @@ class delete_log(ProtectedPage):  # delete log file from web
 
     def GET(self):
         qdict = web.input()
-        with open('./data/pcflog.json', 'w') as f:
-            f.write('')
+        data_log.clear()
+        rollups_store.clear()  # the charts must not show the deleted readings
         raise web.seeother('/pcf')
 
 
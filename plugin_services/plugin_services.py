@@ -0,0 +1,392 @@
+# !/usr/bin/env python
+""" SIP base plugin with services shared by other plugins.
+It has no page of its own, plugins import it with `from plugins import plugin_services`.
+
+Settings: JSON settings files are kept in memory keyed by path.  A file is parsed again
+only when its modification time, size or inode changes, callers get read-only snapshots
+and save() replaces the file atomically.
+
+Live values: the worker thread of a sensor plugin samples the hardware into a LiveValues
+object, pages and JSON endpoints read the last sample from it instead of the bus.
+
+Logs: SegmentedLog appends fixed size binary records to segment files, old segments are
+removed by record count or age, so a write costs the same however much history is kept.
+Readers iterate one segment at a time, downsample() averages records into time buckets.
+
+Timers: one thread keeps a heap of deadlines and blocks in select() until the earliest
+one is due or a new earlier deadline is added.  Plugin threads use a Sleeper, which blocks
+until its deadline or an explicit wake() instead of polling once per second.
+"""
+
+import errno
+import fcntl
+import heapq
+import calendar
+import itertools
+import json
+import os
+import select
+import struct
+import time
+from threading import Thread, Lock, Event
+
+clock = getattr(time, 'monotonic', time.time)  # immune to clock changes where available
+
+
+################################################################################
+# Settings:                                                                    #
+################################################################################
+
+class Snapshot(dict):
+    """Read-only dictionary handed out by SettingsCache, copy it to make changes."""
+
+    def _readonly(self, *args, **kw):
+        raise TypeError('settings snapshots are read-only')
+
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = _readonly
+
+
+def freeze(value):
+    if isinstance(value, dict):
+        return Snapshot((key, freeze(item)) for key, item in value.items())
+    if isinstance(value, list):
+        return tuple(freeze(item) for item in value)
+    return value
+
+
+class SettingsCache(object):
+    """Parsed JSON settings files keyed by path.
+    load() costs one stat() while the file is unchanged.  Like open() it raises IOError
+    when the file is missing and ValueError when it cannot be parsed."""
+
+    def __init__(self):
+        self._files = {}
+        self._lock = Lock()
+
+    @staticmethod
+    def _version(path):
+        try:
+            st = os.stat(path)
+        except OSError as e:
+            raise IOError(e.errno, e.strerror, path)
+        return st.st_mtime, st.st_size, st.st_ino
+
+    def load(self, path):
+        version = self._version(path)
+        with self._lock:
+            cached = self._files.get(path)
+            if cached is not None and cached[0] == version:
+                return cached[1]
+        with open(path, 'r') as f:
+            data = freeze(json.load(f))
+        with self._lock:
+            self._files[path] = (version, data)
+        return data
+
+    def save(self, path, data):
+        """Write data to path through a temporary file and rename, so readers never see a
+        partly written file and a power cut leaves either the old or the new settings."""
+        tmp = path + '.tmp'
+        with self._lock:
+            with open(tmp, 'w') as f:
+                json.dump(data, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(tmp, path)
+            self._files[path] = (self._version(path), freeze(data))
+
+    def invalidate(self, path=None):
+        with self._lock:
+            if path is None:
+                self._files.clear()
+            else:
+                self._files.pop(path, None)
+
+
+settings = SettingsCache()
+
+
+################################################################################
+# Live values:                                                                 #
+################################################################################
+
+class LiveValues(object):
+    """Most recent sensor readings of a plugin and the time they were sampled."""
+
+    def __init__(self, **defaults):
+        self._lock = Lock()
+        self._values = dict(defaults)
+        self.sampled = 0
+
+    def set(self, **values):
+        with self._lock:
+            self._values.update(values)
+            self.sampled = time.time()
+
+    def get(self):
+        """Copy of the values, with the sample time under 'sampled' (0 = never sampled)."""
+        with self._lock:
+            return dict(self._values, sampled=self.sampled)
+
+
+################################################################################
+# Logs:                                                                        #
+################################################################################
+
+class SegmentedLog(object):
+    """Append-only log of fixed size records in numbered segment files in one directory.
+    Every record starts with its time (seconds since the epoch), fmt is the struct format
+    of the remaining fields.  max_records and max_age (seconds) limit what is kept, 0 means
+    unlimited; whole segments are removed when a new one is started and the readers apply
+    the limits exactly."""
+
+    def __init__(self, directory, fmt, segment_records=1000):
+        self.directory = directory
+        self.record = struct.Struct('<d' + fmt)
+        self.segment_records = segment_records
+        self.max_records = 0
+        self.max_age = 0
+        self._lock = Lock()
+        try:
+            self._segments = sorted(int(name[:-4]) for name in os.listdir(directory) if name.endswith('.seg'))
+        except OSError:
+            self._segments = []
+
+    def _path(self, segment):
+        return os.path.join(self.directory, '%08d.seg' % segment)
+
+    def _count(self, segment):
+        try:
+            return os.path.getsize(self._path(segment)) // self.record.size
+        except OSError:
+            return 0
+
+    def _last_time(self, segment):
+        count = self._count(segment)
+        if count == 0:
+            return 0
+        with open(self._path(segment), 'rb') as f:
+            f.seek((count - 1) * self.record.size)
+            return self.record.unpack(f.read(self.record.size))[0]
+
+    def append(self, t, *fields):
+        data = self.record.pack(t, *fields)
+        with self._lock:
+            if not self._segments:
+                if not os.path.isdir(self.directory):
+                    os.makedirs(self.directory)
+                self._segments.append(1)
+            path = self._path(self._segments[-1])
+            size = os.path.getsize(path) if os.path.exists(path) else 0
+            if size >= self.segment_records * self.record.size:
+                self._segments.append(self._segments[-1] + 1)
+                path = self._path(self._segments[-1])
+                size = 0
+                self._retain()
+            with open(path, 'ab') as f:
+                if size % self.record.size:  # partial record left by a power cut
+                    f.truncate(size - size % self.record.size)
+                f.write(data)
+
+    def _retain(self):
+        """Drop the oldest segments that only hold records outside the limits."""
+        while len(self._segments) > 1:
+            oldest = self._segments[0]
+            newer = sum(self._count(segment) for segment in self._segments[1:-1])
+            too_many = self.max_records and newer >= self.max_records
+            too_old = self.max_age and self._last_time(oldest) < time.time() - self.max_age
+            if not (too_many or too_old):
+                break
+            try:
+                os.remove(self._path(oldest))
+            except OSError:
+                pass
+            del self._segments[0]
+
+    def reverse(self, start=None, end=None):
+        """Iterate the records most recent first, as tuples (time, field, ...).
+        start and end limit the record times, only one segment is in memory at a time."""
+        with self._lock:
+            segments = list(self._segments)
+        oldest = time.time() - self.max_age if self.max_age else None
+        count = 0
+        for segment in reversed(segments):
+            try:
+                with open(self._path(segment), 'rb') as f:
+                    data = f.read()
+            except IOError:
+                continue
+            size = self.record.size
+            for offset in range(len(data) // size * size - size, -1, -size):
+                record = self.record.unpack_from(data, offset)
+                if oldest is not None and record[0] < oldest:
+                    return
+                count += 1
+                if end is None or record[0] <= end:
+                    if start is not None and record[0] < start:
+                        return
+                    yield record
+                if self.max_records and count >= self.max_records:
+                    return
+
+    def clear(self):
+        with self._lock:
+            for segment in self._segments:
+                try:
+                    os.remove(self._path(segment))
+                except OSError:
+                    pass
+            self._segments = []
+
+
+def downsample(records, step):
+    """Combine the records of each step seconds into one record at the start of the step.
+    Numeric fields are averaged, other fields keep the value of the first record."""
+    bucket = None
+    group = []
+    for record in records:
+        key = int(record[0] // step)
+        if key != bucket and group:
+            yield _combine(bucket * step, group)
+            group = []
+        bucket = key
+        group.append(record)
+    if group:
+        yield _combine(bucket * step, group)
+
+
+def _combine(t, group):
+    fields = [t]
+    for values in list(zip(*group))[1:]:
+        if isinstance(values[0], (int, float)):
+            fields.append(float(sum(values)) / len(values))
+        else:
+            fields.append(values[0])
+    return tuple(fields)
+
+
+def chunked(lines, count=256):
+    """Join lines into chunks of count lines for a streamed (generator) response."""
+    chunk = []
+    for line in lines:
+        chunk.append(line)
+        if len(chunk) >= count:
+            yield ''.join(chunk)
+            chunk = []
+    if chunk:
+        yield ''.join(chunk)
+
+
+def parse_log_time(value):
+    """Time for a log query: seconds since the epoch or a 'YYYY-MM-DD[ HH:MM]' date in the
+    clock of the log records.  None and '' give None."""
+    if value is None or value == '':
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    for fmt in ('%Y-%m-%d %H:%M', '%Y-%m-%d'):
+        try:
+            return calendar.timegm(time.strptime(value, fmt))
+        except ValueError:
+            pass
+    raise ValueError('invalid time: ' + value)
+
+
+################################################################################
+# Timers:                                                                      #
+################################################################################
+
+class TimerService(object):
+    """Calls functions at their deadline from a single thread.
+    The callbacks run on the timer thread and must return quickly."""
+
+    def __init__(self):
+        self._heap = []
+        self._lock = Lock()
+        self._seq = itertools.count()
+        self._thread = None
+        self._rfd, self._wfd = os.pipe()
+        for fd in (self._rfd, self._wfd):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+    def call_later(self, secs, func):
+        """Run func after secs seconds, returns a handle for cancel()."""
+        entry = [clock() + secs, next(self._seq), func]
+        with self._lock:
+            heapq.heappush(self._heap, entry)
+            earliest = self._heap[0] is entry
+            if self._thread is None:
+                self._thread = Thread(target=self._run, name='plugin_services timers')
+                self._thread.daemon = True
+                self._thread.start()
+        if earliest:
+            self._notify()
+        return entry
+
+    def cancel(self, entry):
+        entry[2] = None  # dropped when it reaches the top of the heap
+
+    def _notify(self):
+        try:
+            os.write(self._wfd, b'.')
+        except OSError as e:
+            if e.errno != errno.EAGAIN:  # a full pipe already wakes the thread
+                raise
+
+    def _run(self):
+        while True:
+            due = []
+            with self._lock:
+                now = clock()
+                while self._heap and self._heap[0][0] <= now:
+                    func = heapq.heappop(self._heap)[2]
+                    if func is not None:
+                        due.append(func)
+                timeout = self._heap[0][0] - now if self._heap else None
+
+            for func in due:
+                try:
+                    func()
+                except Exception as e:
+                    print('plugin_services timer callback failed: ' + str(e))
+            if due:
+                continue
+
+            try:
+                readable = select.select([self._rfd], [], [], timeout)[0]
+            except select.error:  # interrupted by a signal
+                continue
+            if readable:
+                try:
+                    os.read(self._rfd, 512)
+                except OSError:
+                    pass
+
+
+timers = TimerService()
+
+
+class Sleeper(object):
+    """Replacement for the per-second countdown loops in plugin threads.
+    sleep() blocks until the time is up or wake() is called from another thread,
+    sleep(None) until wake() only.
+    A wake() while the owner is busy ends its next sleep() at once, so a signal that
+    arrives between two sleeps is not lost."""
+
+    def __init__(self, service=timers):
+        self._service = service
+        self._event = Event()
+
+    def sleep(self, secs):
+        if secs is None:
+            self._event.wait()
+        elif secs > 0:
+            entry = self._service.call_later(secs, self._event.set)
+            self._event.wait()  # untimed wait blocks without polling
+            self._service.cancel(entry)
+        self._event.clear()
+
+    def wake(self):
+        self._event.set()
@@ -13,7 +13,9 @@ import gv  # Get access to ospi's settings
 from urls import urls  # Get access to ospi's URLs
 from ospi import template_render
 from webpages import ProtectedPage
+from plugins import plugin_services
 from helpers import stop_stations
+from blinker import signal
 
 
 # Add a new url to open the data entry page.
@@ -24,6 +26,9 @@ urls.extend(['/pressa', 'plugins.pressure_adj.settings',
 # Add this plugin to the home page plugins menu
 gv.plugin_menu.append(['Pressure Monitor Settings', '/pressa'])
 
+ACTIVE_CHECK = 1  # seconds between sensor checks while the master station is on
+IDLE_CHECK = 3600  # seconds, zone changes and saved settings wake the thread earlier
+
 ################################################################################
 # GPIO input pullup:                                                           #
 ################################################################################
@@ -52,10 +57,9 @@ class PressureSender(Thread):
     def __init__(self):
         Thread.__init__(self)
         self.daemon = True
-        self.start()
         self.status = ''
-
-        self._sleep_time = 0
+        self._sleeper = plugin_services.Sleeper()
+        self.start()
 
     def add_status(self, msg):
         if self.status:
@@ -65,13 +69,16 @@ class PressureSender(Thread):
         print msg
 
     def update(self):
-        self._sleep_time = 0
+        self._sleeper.wake()
 
     def _sleep(self, secs):
-        self._sleep_time = secs
-        while self._sleep_time > 0:
-            time.sleep(1)
-            self._sleep_time -= 1
+        self._sleeper.sleep(secs)
+
+    def _sleep_full(self, secs):
+        """Sleeps the whole time, a wake() does not cut it short."""
+        deadline = time.time() + secs
+        while time.time() < deadline:
+            self._sleep(deadline - time.time())
 
     def run(self):
         time.sleep(randint(3, 10))  # Sleep some time to prevent printing before startup information
@@ -82,12 +89,14 @@ class PressureSender(Thread):
 
         while True:
             try:
+                master_on = False
                 datapressure = get_pressure_options()                             # load data from file
                 if datapressure['press'] != 'off':                                # if pressure plugin is enabled
                     if (gv.sd['mas'] != 0) and not (gv.sd['mm']):                   # if is use master station and not manual control
                         if gv.srvals[gv.sd['mas']] != 0:                              # if master station is ON
+                            master_on = True
                             if GPIO.input(pin_pressure) == 0:                           # if sensor is open
-                                self._sleep(int(datapressure['time']))                   # wait to activated pressure sensor
+                                self._sleep_full(int(datapressure['time']))              # wait to activated pressure sensor
                                 if GPIO.input(pin_pressure) == 0:                        # if sensor is current open
                                     stop_stations()
                                     self.add_status('Pressure sensor is not activated in time -> stops all stations and sends email.')
@@ -109,7 +118,8 @@ class PressureSender(Thread):
                     except Exception as err:
                         self.add_status('Email was not sent! ' + str(err))
 
-                self._sleep(1)
+                # the master station switching on wakes the thread through the zone_change signal
+                self._sleep(ACTIVE_CHECK if master_on else IDLE_CHECK)
 
             except Exception:
                 exc_type, exc_value, exc_traceback = sys.exc_info()
@@ -120,6 +130,13 @@ class PressureSender(Thread):
 
 checker = PressureSender()
 
+
+def notify_zone_change(name, **kw):
+    checker.update()
+
+zones = signal('zone_change')
+zones.connect(notify_zone_change)
+
 ################################################################################
 # Helper functions:                                                            #
 ################################################################################
@@ -135,8 +152,7 @@ def get_pressure_options():
         'status': checker.status
     }
     try:
-        with open('./data/pressure_adj.json', 'r') as f:  # Read the settings from file
-            file_data = json.load(f)
+        file_data = plugin_services.settings.load('./data/pressure_adj.json')  # Read the settings from file
         for key, value in file_data.iteritems():
             if key in datapressure:
                 datapressure[key] = value
@@ -184,7 +200,6 @@ class update(ProtectedPage):
             qdict['press'] = 'off'
         if 'sendeml' not in qdict:
             qdict['sendeml'] = 'off'
-        with open('./data/pressure_adj.json', 'w') as f:  # write the settings to file
-            json.dump(qdict, f)
+        plugin_services.settings.save('./data/pressure_adj.json', qdict)  # write the settings to file
         checker.update()
         raise web.seeother('/')
@@ -2,8 +2,10 @@
 
 from threading import Thread
 from random import randint
+import calendar
 import json
 import time
+import os
 import sys
 import traceback
 import web
@@ -11,6 +13,7 @@ import gv  # Get access to ospi's settings
 from urls import urls  # Get access to ospi's URLs
 from ospi import template_render
 from webpages import ProtectedPage
+from plugins import plugin_services
 from helpers import get_rpi_revision
 from blinker import signal
 
@@ -21,6 +24,16 @@ try:
 except ImportError:
     PC_i2C = None
 
+SAMPLE_INTERVAL = 5  # seconds between live samples of pressure and status
+IDLE_CHECK = 3600  # seconds while the plugin is disabled, saving the settings wakes the thread
+
+# Last values read from the controller, shown on the page and in the JSON settings
+live = plugin_services.LiveValues(pressure_val='0', pump_status_val='ERROR',
+                                  pump_control_config={'max_pressure': 0, 'min_pressure': 0, 'max_wait': 0})
+
+# Logged values: time, pressure, status text
+data_log = plugin_services.SegmentedLog('./data/pump_control_log', 'f32s')
+
 # Add a new url to open the data entry page.
 urls.extend(['/pcontrol', 'plugins.pump_control.settings',
              '/pcontrolj', 'plugins.pump_control.settings_json',
@@ -41,11 +54,9 @@ class PumpControlSender(Thread):
     def __init__(self):
         Thread.__init__(self)
         self.daemon = True
-        self.start()
         self.status = ''
-
-
-        self._sleep_time = 0
+        self._sleeper = plugin_services.Sleeper()
+        self.start()
 
     def add_status(self, msg):
         if self.status:
@@ -55,32 +66,36 @@ class PumpControlSender(Thread):
         print msg
 
     def update(self):
-        self._sleep_time = 0
+        self._sleeper.wake()
+        live.set(pump_control_config=get_now_config())
         nconf = get_pump_control_options()['pump_control_config']
-        if get_now_config() != nconf: # if the new config is different from the one in arduino
+        if live.get()['pump_control_config'] != nconf: # if the new config is different from the one in arduino
             set_now_config(nconf)
+            live.set(pump_control_config=dict(nconf))
 
     def _sleep(self, secs):
-        self._sleep_time = secs
-        while self._sleep_time > 0:
-            time.sleep(1)
-            self._sleep_time -= 1
+        self._sleeper.sleep(secs)
 
     def run(self):
         time.sleep(randint(3, 10))  # Sleep some time to prevent printing before startup information
         print "Pump Control plugin is active"
         last_time = gv.now
+        last_sample = 0
         self.update()
         while True:
             try:
+                wait = IDLE_CHECK
                 datapc = get_pump_control_options()  # load data from file
                 if datapc['use_pc'] != 'off':  # if pcf plugin is enabled
+                    if time.time() - last_sample >= SAMPLE_INTERVAL:
+                        sample_pump()
+                        last_sample = time.time()
+                    wait = last_sample + SAMPLE_INTERVAL - time.time()
                     if datapc['use_log'] != 'off' and datapc[
                         'time'] != '0':  # if log is enabled and time is not 0 min
                         actual_time = gv.now
                         if actual_time - last_time > (int(datapc['time'])):  # if is time for save
-                            pressure = get_now_pressure()
-                            pc_status = get_now_status()
+                            pressure, pc_status = sample_pump()
                             last_time = actual_time
                             self.status = ''
                             TEXT = 'On ' + time.strftime('%d.%m.%Y at %H:%M:%S', time.localtime(time.time())) + \
@@ -90,7 +105,8 @@ class PumpControlSender(Thread):
                             write_log(pressure, pc_status)
                             if "ALARM" in pc_status:
                                 alarm.send("pump_control", txt=pc_status)
-                self._sleep(1)
+                        wait = min(wait, last_time + int(datapc['time']) + 1 - actual_time)
+                self._sleep(max(1, wait))  # until the next sample or log entry is due
 
             except Exception:
                 exc_type, exc_value, exc_traceback = sys.exc_info()
@@ -132,6 +148,13 @@ def get_now_status():
 
     return out
 
+def sample_pump():
+    """Read pressure and status and store them as the live values"""
+    pressure = get_now_pressure()
+    pc_status = get_now_status()
+    live.set(pressure_val=pressure, pump_status_val=pc_status)
+    return pressure, pc_status
+
 def get_now_config():
     l = {
         'max_pressure': 0,
@@ -156,20 +179,19 @@ def set_now_config(dict):
 
 
 def get_pump_control_options():
-    """Returns the data form file."""
+    """Returns the data form file, without touching the I2C bus.
+    Without saved settings the controller configuration last read from the arduino is used."""
     datapc = {
         'use_pc': 'off',
         'use_log': 'off',
         'time': '0',
         'records': '0',
-        'pressure_val': get_now_pressure(),
-        'pump_status_val': get_now_status(),
-        'pump_control_config': get_now_config(),
+        'days': '0',
+        'pump_control_config': live.get()['pump_control_config'],
         'status': checker.status
     }
     try:
-        with open('./data/pump_control.json', 'r') as f:  # Read the settings from file
-            file_data = json.load(f)
+        file_data = plugin_services.settings.load('./data/pump_control.json')  # Read the settings from file
         for key, value in file_data.iteritems():
             if key in datapc:
                 datapc[key] = value
@@ -179,42 +201,62 @@ def get_pump_control_options():
             'use_log': 'off',
             'time': '0',
             'records': '0',
-            'pressure_val': get_now_pressure(),
-            'pump_status_val': get_now_status(),
-            'pump_control_config': get_now_config(),
+            'days': '0',
+            'pump_control_config': datapc['pump_control_config'],
             'status': checker.status
         }
 
-        with open('./data/pump_control.json', 'w') as f:  # write defalult settings to file
-            json.dump(defaultpcf, f)
+        plugin_services.settings.save('./data/pump_control.json', defaultpcf)  # write defalult settings to file
 
     except Exception:
         pass
 
     return datapc
 
-def read_log():
-    """Read pump_control log"""
+
+def get_pump_control_values():
+    """Returns the settings together with the last sampled pressure and status."""
+    datapc = live.get()
+    datapc.update(get_pump_control_options())
+    return datapc
+
+def set_log_limits():
+    datapc = get_pump_control_options()
+    data_log.max_records = int(datapc['records'])
+    data_log.max_age = int(datapc['days']) * 24 * 3600
+
+
+def read_log(start=None, end=None):
+    """Read pump_control log - most recent first, as (time, pressure, status)."""
+    for t, pressure, status in data_log.reverse(start, end):
+        yield t, pressure, status.rstrip('\0')
+
+
+def write_log(pressure, status):
+    """Append run data to the log."""
+    set_log_limits()
+    data_log.append(gv.now, float(pressure), str(status))
+    return
+
+
+def import_json_log():
+    """Move the records of the pump_control_log.json file of older versions to the log."""
     try:
         with open('./data/pump_control_log.json') as logf:
             records = logf.readlines()
-        return records
     except IOError:
-        return []
+        return
+    for r in reversed(records):  # oldest first
+        try:
+            event = json.loads(r)
+            t = calendar.timegm(time.strptime(event["Date"] + " " + event["Time"], '%d-%m-%Y %H:%M:%S'))
+            data_log.append(t, float(event["Pressure"]), str(event["Status"]))
+        except (ValueError, KeyError):
+            continue
+    os.rename('./data/pump_control_log.json', './data/pump_control_log.json.bak')
 
-
-def write_log(pressure, status):
-    """Add run data to csv file - most recent first."""
-    datapc = get_pump_control_options()
-    logline = '{"Time":"' + time.strftime('%H:%M:%S","Date":"%d-%m-%Y"', time.gmtime(gv.now)) + ',"Pressure":"' + str(pressure) + '","Status":"' + str(status) + '"}\n'
-    log = read_log()
-    log.insert(0, logline)
-    with open('./data/pump_control_log.json', 'w') as f:
-        if int(datapc['records']) != 0:
-            f.writelines(log[:int(datapc['records'])])
-        else:
-            f.writelines(log)
-    return
+import_json_log()
+set_log_limits()
 
 
 ################################################################################
@@ -226,7 +268,7 @@ class settings(ProtectedPage):
     """Load an html page for entering lcd adjustments."""
 
     def GET(self):
-        return template_render.pump_control(get_pump_control_options())
+        return template_render.pump_control(get_pump_control_values())
 
 
 class settings_json(ProtectedPage):
@@ -235,7 +277,7 @@ class settings_json(ProtectedPage):
     def GET(self):
         web.header('Access-Control-Allow-Origin', '*')
         web.header('Content-Type', 'application/json')
-        return json.dumps(get_pump_control_options())
+        return json.dumps(get_pump_control_values())
 
 
 class update(ProtectedPage):
@@ -256,24 +298,50 @@ class update(ProtectedPage):
         del(qdict['max_pressure'])
         del(qdict['min_pressure'])
         del(qdict['max_wait'])
-        with open('./data/pump_control.json', 'w') as f:  # write the settings to file
-            json.dump(qdict, f)
+        plugin_services.settings.save('./data/pump_control.json', qdict)  # write the settings to file
         checker.update()
         raise web.seeother('/')
 
 
+def log_csv(records):
+    """Yields the records as CSV lines with a header."""
+    yield "Date, Time, Pressure, Pump Control Status\n"
+    for t, pressure, status in records:
+        yield time.strftime('%d-%m-%Y, %H:%M:%S', time.gmtime(t)) + ", " + str(int(pressure)) + ", " + str(
+            status)  + "\n"
+
+
+def log_ndjson(records):
+    """Yields the records as JSON lines, in the format of the older pump_control_log.json file."""
+    for t, pressure, status in records:
+        yield json.dumps({"Date": time.strftime('%d-%m-%Y', time.gmtime(t)),
+                          "Time": time.strftime('%H:%M:%S', time.gmtime(t)),
+                          "Pressure": int(pressure), "Status": status}) + "\n"
+
+
 class pump_control_log(ProtectedPage):  # save log file from web as csv file type
-    """Simple PCF Log API"""
+    """Simple Pump Control Log API, streamed most recent first.
+    Query parameters (all optional):
+      start, end - time range, unix timestamps or YYYY-MM-DD[ HH:MM] dates
+      step - seconds, the pressure of each step is averaged into one record
+      format - "csv" or "ndjson"
+    """
 
     def GET(self):
-        records = read_log()
-        data = "Date, Time, Pressure, Pump Control Status\n"
-        for r in records:
-            event = json.loads(r)
-            data += event["Date"] + ", " + event["Time"] + ", " + str(event["Pressure"]) + ", " + str(
-                event["Status"])  + "\n"
+        qdict = web.input(start=None, end=None, step=None, format='csv')
+        try:
+            records = read_log(plugin_services.parse_log_time(qdict.start),
+                               plugin_services.parse_log_time(qdict.end))
+            step = int(qdict.step) if qdict.step else 0
+        except ValueError:
+            raise web.badrequest()
+        if step > 0:
+            records = plugin_services.downsample(records, step)
+        if qdict.format == 'ndjson':
+            web.header('Content-Type', 'application/x-ndjson')
+            return plugin_services.chunked(log_ndjson(records))
         web.header('Content-Type', 'text/csv')
-        return data
+        return plugin_services.chunked(log_csv(records))
 
 
 class delete_log(ProtectedPage):  # delete log file from web
@@ -281,8 +349,7 @@ class delete_log(ProtectedPage):  # delete log file from web
 
     def GET(self):
         qdict = web.input()
-        with open('./data/pump_control_log.json', 'w') as f:
-            f.write('')
+        data_log.clear()
         raise web.seeother('/pcontrol')
 
 
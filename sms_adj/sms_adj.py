@@ -14,6 +14,7 @@ from helpers import get_ip, uptime, reboot, poweroff, timestr, jsave, restart
 from urls import urls  # Get access to ospi's URLs
 from ospi import template_render
 from webpages import ProtectedPage
+from plugins import plugin_services
 
 
 # Add a new url to open the data entry page.
@@ -38,10 +39,9 @@ class SMS(Thread):
     def __init__(self):
         Thread.__init__(self)
         self.daemon = True
-        self.start()
         self.status = ''
-
-        self._sleep_time = 0
+        self._sleeper = plugin_services.Sleeper()
+        self.start()
 
     def add_status(self, msg):
         if self.status:
@@ -51,13 +51,10 @@ class SMS(Thread):
         print msg
 
     def update(self):
-        self._sleep_time = 0
+        self._sleeper.wake()
 
     def _sleep(self, secs):
-        self._sleep_time = secs
-        while self._sleep_time > 0:
-            time.sleep(1)
-            self._sleep_time -= 1
+        self._sleeper.sleep(secs)
 
     def run(self):
         time.sleep(randint(3, 10))  # Sleep some time to prevent printing before startup information
@@ -101,8 +98,7 @@ def get_sms_options():
     }
 
     try:
-        with open('./data/sms_adj.json', 'r') as f:  # Read the settings from file
-            file_data = json.load(f)
+        file_data = plugin_services.settings.load('./data/sms_adj.json')  # Read the settings from file
         for key, value in file_data.iteritems():
             if key in data:
                 data[key] = value
@@ -304,7 +300,6 @@ class update(ProtectedPage):
         qdict = web.input()
         if 'use_sms' not in qdict:
             qdict['use_sms'] = 'off'
-        with open('./data/sms_adj.json', 'w') as f:  # write the settings to file
-            json.dump(qdict, f)
+        plugin_services.settings.save('./data/sms_adj.json', qdict)  # write the settings to file
         checker.update()
         raise web.seeother('/')
@@ -5,6 +5,7 @@ import gv  # Get access to sip's settings
 from urls import urls  # Get access to sip's URLs
 from sip import template_render  #  Needed for working with web.py templates
 from webpages import ProtectedPage  # Needed for security
+from plugins import plugin_services
 import json  # for working with data file
 from telegram.ext import Updater, CommandHandler, MessageHandler, Filters
 
@@ -37,8 +38,8 @@ class SipBot(Thread):
         self.gv = globals
         self.bot = None
         self._currentChats = set([])
-        self.start()
         self.status = ''
+        self.start()
 
     @property
     def currentChats(self):
@@ -308,8 +309,7 @@ def get_telegramBot_options():
         'currentChats' : []
         }
     try:
-        with open(json_data, 'r') as f:  # Read the settings from file
-            file_data = json.load(f)
+        file_data = plugin_services.settings.load(json_data)  # Read the settings from file
         for key, value in file_data.iteritems():
             if key in data:
                 data[key] = value
@@ -322,8 +322,7 @@ def set_telegramBot_options(new_data):
         data = get_telegramBot_options()
         for k in new_data.keys():
             data[k] =  new_data[k]
-        with open('./data/telegramBot.json', 'w') as f:
-            json.dump(data, f) # save to file
+        plugin_services.settings.save('./data/telegramBot.json', data) # save to file
         return
 
 def run_bot():
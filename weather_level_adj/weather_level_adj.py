@@ -1,7 +1,10 @@
 # !/usr/bin/env python
 import datetime
+import math
 from random import randint
-from threading import Thread
+from threading import Thread, Event, Lock, local
+import Queue
+import httplib
 import sys
 import traceback
 import shutil
@@ -10,14 +13,13 @@ import time
 import re
 import os
 import urllib
-import urllib2
-import errno
 
 import web
 import gv  # Get access to ospi's settings
 from urls import urls  # Get access to ospi's URLs
 from ospi import template_render
 from webpages import ProtectedPage
+from plugins import plugin_services
 
 def safe_float(s):
   try:
@@ -25,14 +27,15 @@ def safe_float(s):
   except:
     return 0
 
-def mkdir_p(path):
-    try:
-        os.makedirs(path)
-    except OSError as exc:  # Python >2.5
-        if exc.errno == errno.EEXIST and os.path.isdir(path):
-            pass
-        else:
-            raise
+WU_API_HOST = 'api.wunderground.com'                    # may point to a local stand-in server for testing
+WU_AUTOCOMPLETE_HOST = 'autocomplete.wunderground.com'
+LID_TTL = 24 * 3600         # seconds the resolved location ID is reused
+FETCH_WORKERS = 4           # concurrent weather requests
+HISTORY_FILE = './data/weather_level_history.json'
+RETENTION_DAYS = 60         # days of weather records kept in HISTORY_FILE
+REPLAY_FILE = './data/weather_level_replay.json'
+HTTP_TIMEOUT = 20           # seconds
+
 
 # Add a new url to open the data entry page.
 urls.extend(['/lwa',  'plugins.weather_level_adj.settings',
@@ -51,10 +54,9 @@ class WeatherLevelChecker(Thread):
     def __init__(self):
         Thread.__init__(self)
         self.daemon = True
-        self.start()
         self.status = ''
-
-        self._sleep_time = 0
+        self._sleeper = plugin_services.Sleeper()
+        self.start()
 
     def add_status(self, msg):
         if self.status:
@@ -64,13 +66,10 @@ class WeatherLevelChecker(Thread):
         print msg
 
     def update(self):
-        self._sleep_time = 0
+        self._sleeper.wake()
 
     def _sleep(self, secs):
-        self._sleep_time = secs
-        while self._sleep_time > 0:
-            time.sleep(1)
-            self._sleep_time -= 1
+        self._sleeper.sleep(secs)
 
     def run(self):
         time.sleep(randint(3, 10))  # Sleep some time to prevent printing before startup information
@@ -82,14 +81,22 @@ class WeatherLevelChecker(Thread):
                 if options["auto_wl"] == "off":
                     if 'wl_weather' in gv.sd:
                         del gv.sd['wl_weather']
+                    self._sleep(None)  # until update() is called for new settings
                 else:
 
                     print "Checking weather status..."
-                    remove_data(['history_', 'conditions_', 'forecast10day_'])
+                    weather_store.compact(RETENTION_DAYS)
+
+                    provider = get_provider(options['provider'])
+                    history, forecast, today = provider.fetch(self, int(options['days_history']),
+                                                              int(options['days_forecast']))
+                    weather_store.save()
 
-                    history = history_info(self)
-                    forecast = forecast_info(self)
-                    today = today_info(self)
+                    model = options['et_model']
+                    if model == 'hargreaves' and str(options['latitude']).strip() == '':
+                        raise Exception('The Hargreaves ET model needs the site latitude!')
+                    version = '%s|%s|%s|%s' % (options['provider'], provider.location(), model, options['latitude'])
+                    water_needs.compact(-20)
 
                     info = {}
 
@@ -101,7 +108,7 @@ class WeatherLevelChecker(Thread):
                         else:
                             continue
 
-                        info[day] = day_info
+                        info[day] = dict(day_info)
 
                     if 0 in info and 'rain_mm' in today:
                         day_time = datetime.datetime.now().time()
@@ -117,19 +124,16 @@ class WeatherLevelChecker(Thread):
                     self.add_status('Using %d days of information.' % len(info))
 
                     total_info = {
-                        'temp_c': sum([val['temp_c'] for val in info.values()])/len(info),
-                        'rain_mm': sum([val['rain_mm'] for val in info.values()]),
-                        'wind_ms': sum([val['wind_ms'] for val in info.values()])/len(info),
-                        'humidity': sum([val['humidity'] for val in info.values()])/len(info)
+                        'rain_mm': sum([val['rain_mm'] for val in info.values()])
                     }
 
                     # We assume that the default 100% provides 4mm water per day (normal need)
-                    # We calculate what we will need to provide using the mean data of X days around today
+                    # The need of past days is cached, only today and the forecast days are computed
 
-                    water_needed = 4 * len(info)                                # 4mm per day
-                    water_needed *= 1 + (total_info['temp_c'] - 20) / 15        # 5 => 0%, 35 => 200%
-                    water_needed *= 1 + (total_info['wind_ms'] / 100)           # 0 => 100%, 20 => 120%
-                    water_needed *= 1 - (total_info['humidity'] - 50) / 200     # 0 => 125%, 100 => 75%
+                    water_needed = 0
+                    for day, day_info in info.iteritems():
+                        water_needed += water_needs.need(day, day_info, version,
+                                                         model, safe_float(options['latitude']))
                     water_needed = round(water_needed, 1)
 
                     water_left = water_needed - total_info['rain_mm']
@@ -145,6 +149,7 @@ class WeatherLevelChecker(Thread):
 
                     self.add_status('Current temp in C    : %.1f' % today['temp_c'])
                     self.add_status('________________________________')
+                    self.add_status('Water need model     : %s' % model)
                     self.add_status('Water needed (%d days): %.1fmm' % (len(info), water_needed))
                     self.add_status('Total rainfall       : %.1fmm' % total_info['rain_mm'])
                     self.add_status('________________________________')
@@ -160,7 +165,6 @@ class WeatherLevelChecker(Thread):
                 err_string = ''.join(traceback.format_exception(exc_type, exc_value, exc_traceback))
                 self.add_status('Weather-base water level encountered error:\n' + err_string)
                 self._sleep(3600)
-            time.sleep(0.5)
 
 checker = WeatherLevelChecker()
 
@@ -191,8 +195,7 @@ class update(ProtectedPage):
         qdict = web.input()
         if 'auto_wl' not in qdict:
             qdict['auto_wl'] = 'off'
-        with open('./data/weather_level_adj.json', 'w') as f:  # write the settings to file
-            json.dump(qdict, f)
+        plugin_services.settings.save('./data/weather_level_adj.json', qdict)  # write the settings to file
         checker.update()
         raise web.seeother('/')
 
@@ -201,6 +204,79 @@ class update(ProtectedPage):
 # Helper functions:                                                            #
 ################################################################################
 
+class _Job(object):
+    def __init__(self, func, args):
+        self.func = func
+        self.args = args
+        self.value = None
+        self.error = None
+        self.done = Event()
+
+    def result(self):
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+
+class FetchPool(object):
+    """Bounded pool of worker threads for weather requests.
+    Each worker keeps its own HTTP connections open between requests (see http_get)."""
+
+    def __init__(self, workers):
+        self._jobs = Queue.Queue()
+        for i in range(workers):
+            worker = Thread(target=self._work)
+            worker.daemon = True
+            worker.start()
+
+    def _work(self):
+        while True:
+            job = self._jobs.get()
+            try:
+                job.value = job.func(*job.args)
+            except Exception as err:
+                job.error = err
+            job.done.set()
+
+    def submit(self, func, *args):
+        job = _Job(func, args)
+        self._jobs.put(job)
+        return job
+
+    def map(self, func, items):
+        jobs = [self.submit(func, item) for item in items]
+        return [job.result() for job in jobs]
+
+
+fetch_pool = FetchPool(FETCH_WORKERS)
+_connections = local()
+
+
+def http_get(host, path):
+    """GET path from host over a persistent per-thread connection, reconnecting once if it went stale."""
+    if not hasattr(_connections, 'conns'):
+        _connections.conns = {}
+    conns = _connections.conns
+    for attempt in range(2):
+        conn = conns.get(host)
+        if conn is None:
+            conn = conns[host] = httplib.HTTPConnection(host, timeout=HTTP_TIMEOUT)
+        try:
+            conn.request('GET', path)
+            response = conn.getresponse()
+            data = response.read()
+        except (httplib.HTTPException, IOError):
+            conn.close()
+            del conns[host]
+            if attempt:
+                raise
+            continue
+        if response.status != 200:
+            raise Exception('HTTP error %d for http://%s%s' % (response.status, host, path))
+        return data
+
+
 def options_data():
     # Defaults:
     result = {
@@ -212,11 +288,13 @@ def options_data():
         'days_history': 3,
         'days_forecast': 3,
         'wapikey': '',
+        'provider': 'wunderground',
+        'et_model': 'linear',
+        'latitude': '',
         'status': checker.status
     }
     try:
-        with open('./data/weather_level_adj.json', 'r') as f:  # Read the settings from file
-            file_data = json.load(f)
+        file_data = plugin_services.settings.load('./data/weather_level_adj.json')  # Read the settings from file
         for key, value in file_data.iteritems():
             if key in result:
                 result[key] = value
@@ -226,46 +304,155 @@ def options_data():
     return result
 
 
+class WeatherStore(object):
+    """Normalized daily weather records (temp_c, tmin_c, rain_mm, wind_ms, humidity) in a single file.
+    Records are keyed by location, date and kind ('history' or 'forecast') so lookups are a
+    dictionary access, and compact() drops everything older than the retention period."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = Lock()
+        self._dirty = False
+        try:
+            with open(path, 'r') as f:
+                self.records = json.load(f)
+        except (IOError, ValueError):
+            self.records = {}
+
+    @staticmethod
+    def _key(lid, date, kind):
+        return '%s|%s|%s' % (lid, date.strftime('%Y-%m-%d'), kind)
+
+    def get(self, lid, date, kind):
+        with self._lock:
+            return self.records.get(self._key(lid, date, kind))
+
+    def put(self, lid, date, kind, record):
+        with self._lock:
+            self.records[self._key(lid, date, kind)] = record
+            self._dirty = True
+
+    def compact(self, days):
+        oldest = (datetime.date.today() - datetime.timedelta(days=days)).strftime('%Y-%m-%d')
+        with self._lock:
+            keep = dict((key, rec) for key, rec in self.records.iteritems() if key.split('|')[-2] >= oldest)
+            if len(keep) != len(self.records):
+                self.records = keep
+                self._dirty = True
+
+    def save(self):
+        """Write the records if they changed, atomically so a power cut cannot corrupt the file."""
+        with self._lock:
+            if not self._dirty:
+                return
+            tmp = self.path + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(self.records, f)
+            os.rename(tmp, self.path)
+            self._dirty = False
+
+
+weather_store = WeatherStore(HISTORY_FILE)
+if os.path.isdir(os.path.join('.', 'data', 'weather_level_history')):
+    shutil.rmtree(os.path.join('.', 'data', 'weather_level_history'))  # per-request files of older versions
+
+
+def linear_water_need(record, date, latitude):
+    """Daily need in mm from the heuristic around 4mm per day at 20C, no wind and 50% humidity."""
+    need = 4.0
+    need *= 1 + (record['temp_c'] - 20) / 15.0          # 5 => 0%, 35 => 200%
+    need *= 1 + (record['wind_ms'] / 100.0)             # 0 => 100%, 20 => 120%
+    need *= 1 - (record['humidity'] - 50) / 200.0       # 0 => 125%, 100 => 75%
+    return need
+
+
+def hargreaves_et0(record, date, latitude):
+    """Reference evapotranspiration in mm per day (FAO-56 Hargreaves equation).
+    Needs the daily maximum (temp_c) and minimum (tmin_c) temperatures, records without a
+    minimum fall back to the linear heuristic."""
+    if 'tmin_c' not in record:
+        return linear_water_need(record, date, latitude)
+    tmax = max(record['temp_c'], record['tmin_c'])
+    tmin = min(record['temp_c'], record['tmin_c'])
+
+    # extraterrestrial radiation for the latitude and day of the year
+    day_angle = 2 * math.pi * date.timetuple().tm_yday / 365.0
+    dr = 1 + 0.033 * math.cos(day_angle)
+    decl = 0.409 * math.sin(day_angle - 1.39)
+    phi = math.radians(latitude)
+    ws = math.acos(max(-1.0, min(1.0, -math.tan(phi) * math.tan(decl))))
+    ra = 24 * 60 / math.pi * 0.0820 * dr * (ws * math.sin(phi) * math.sin(decl) +
+                                            math.cos(phi) * math.cos(decl) * math.sin(ws))
+
+    et0 = 0.0023 * ((tmax + tmin) / 2 + 17.8) * math.sqrt(tmax - tmin) * 0.408 * ra
+    return max(0.0, et0)
+
+
+ET_MODELS = {
+    'linear': linear_water_need,
+    'hargreaves': hargreaves_et0
+}
+
+
+class WaterNeedCache(object):
+    """Daily water need in mm keyed by date and settings version.
+    Past days never change, so their need is computed once when the day arrives. Today and
+    the forecast days are recomputed on every check because their records still change."""
+
+    def __init__(self):
+        self._needs = {}
+
+    def need(self, day, record, version, model, latitude):
+        date = datetime.date.today() + datetime.timedelta(days=day)
+        key = (date, version)
+        if day < 0 and key in self._needs:
+            return self._needs[key]
+        need = ET_MODELS[model](record, date, latitude)
+        if day < 0:
+            self._needs[key] = need
+        return need
+
+    def compact(self, days):
+        oldest = datetime.date.today() + datetime.timedelta(days=days)
+        for key in [key for key in self._needs if key[0] < oldest]:
+            del self._needs[key]
+
+
+water_needs = WaterNeedCache()
+
+
 # Resolve location to LID
+_lid_cache = {'loc': None, 'lid': '', 'time': 0}
+_lid_lock = Lock()
+
+
 def get_wunderground_lid():
-    if re.search("pws:", gv.sd['loc']):
-        lid = gv.sd['loc']
-    else:
-        data = urllib2.urlopen("http://autocomplete.wunderground.com/aq?h=0&query="+urllib.quote_plus(gv.sd['loc']))
-        data = json.load(data)
-        if data is None:
-            return ""
-        elif len(data['RESULTS']) == 0:
-            return ""
-        lid = "zmw:" + data['RESULTS'][0]['zmw']
+    with _lid_lock:
+        if _lid_cache['loc'] == gv.sd['loc'] and _lid_cache['lid'] and time.time() - _lid_cache['time'] < LID_TTL:
+            return _lid_cache['lid']
+        if re.search("pws:", gv.sd['loc']):
+            lid = gv.sd['loc']
+        else:
+            data = json.loads(http_get(WU_AUTOCOMPLETE_HOST, "/aq?h=0&query="+urllib.quote_plus(gv.sd['loc'])))
+            if data is None:
+                return ""
+            elif len(data['RESULTS']) == 0:
+                return ""
+            lid = "zmw:" + data['RESULTS'][0]['zmw']
 
-    return lid
+        _lid_cache.update({'loc': gv.sd['loc'], 'lid': lid, 'time': time.time()})
+        return lid
 
 
-def get_data(suffix, name=None, force=False):
-    if name is None:
-        name = suffix
+def get_data(suffix):
     options = options_data()
-    path = os.path.join('.', 'data', 'weather_level_history', name)
-    directory = os.path.dirname(path)
-    mkdir_p(directory)
     try_nr = 1
     while try_nr <= 2:
         try:
-            if not os.path.exists(path) or force:
-                with open(path, 'wb') as fh:
-                    req = urllib2.urlopen("http://api.wunderground.com/api/"+options['wapikey']+"/" + suffix)
-                    while True:
-                        chunk = req.read(20480)
-                        if not chunk:
-                            break
-                        fh.write(chunk)
-
             try:
-                with file(path, 'r') as fh:
-                    data = json.load(fh)
+                data = json.loads(http_get(WU_API_HOST, "/api/"+options['wapikey']+"/" + suffix))
             except ValueError:
-                raise Exception('Failed to read ' + path + '.')
+                raise Exception('Failed to read ' + suffix + '.')
 
             if data is not None:
                 if 'error' in data['response']:
@@ -279,7 +466,6 @@ def get_data(suffix, name=None, force=False):
         except Exception as err:
             if try_nr < 2:
                 print str(err), 'Retrying.'
-                os.remove(path)
                 # If we had an exception, this is where we need to increase
                 # our count retry
                 try_nr += 1
@@ -289,53 +475,117 @@ def get_data(suffix, name=None, force=False):
     return data
 
 
-def remove_data(prefixes):
-    # Delete old files
-    for prefix in prefixes:
-        check_date = datetime.date.today()
-        start_delta = datetime.timedelta(days=14)
-        day_delta = datetime.timedelta(days=1)
-        check_date -= start_delta
-        for index in range(60):
-            datestring = check_date.strftime('%Y%m%d')
-            path = os.path.join('.', 'data', 'weather_level_history', prefix + datestring)
-            if os.path.isdir(path):
-                shutil.rmtree(path)
-            check_date -= day_delta
-
-
 ################################################################################
-# Info queries:                                                                #
+# Weather providers:                                                           #
 ################################################################################
 
-def history_info(obj):
-    options = options_data()
-    if int(options['days_history']) == 0:
-        return {}
+class WeatherProvider(object):
+    """Source of weather data for the water level calculation.
+    fetch() returns (history, forecast, today): history and forecast map day offsets from
+    today (-1, -2, ... and 0, 1, ...) to normalized daily records
+    {'temp_c', 'rain_mm', 'wind_ms', 'humidity'} (plus 'tmin_c' when the daily minimum is
+    known, temp_c is then the daily maximum) and today is the record of the current
+    conditions.  Each provider decides how to batch and cache its own requests."""
 
-    lid = get_wunderground_lid()
-    if lid == "":
-        raise Exception('No Location ID found!')
+    def fetch(self, obj, days_history, days_forecast):
+        raise NotImplementedError
 
-    check_date = datetime.date.today()
-    day_delta = datetime.timedelta(days=1)
+    def location(self):
+        """Key of the place the data comes from, part of the cached water need version."""
+        raise NotImplementedError
 
-    info = {}
-    for index in range(-1, -1 - int(options['days_history']), -1):
-        check_date -= day_delta
-        datestring = check_date.strftime('%Y%m%d')
-        request = "history_"+datestring+"/q/"+lid+".json"
 
-        data = get_data(request)
+class WundergroundProvider(WeatherProvider):
+    """Wunderground API: one request per history day, sent concurrently, plus one forecast
+    and one conditions request.  Past days and the daily forecast are cached in weather_store."""
+
+    def fetch(self, obj, days_history, days_forecast):
+        lid = get_wunderground_lid()
+        if lid == "":
+            raise Exception('No Location ID found!')
+
+        # forecast and today go out while the history days are fetched
+        forecast_job = fetch_pool.submit(forecast_info, obj, lid, days_forecast)
+        today_job = fetch_pool.submit(today_info, obj, lid)
+        history = history_info(obj, lid, days_history)
+        return history, forecast_job.result(), today_job.result()
 
-        if data and len(data['history']['dailysummary']) > 0:
-            info[index] = data['history']['dailysummary'][0]
+    def location(self):
+        return gv.sd['loc']
+
+
+class ReplayProvider(WeatherProvider):
+    """Replays normalized records from a local file, for testing and for sites without
+    internet access.  The whole file is one bulk request:
+        {"days": {"YYYY-MM-DD": {record}, ...}, "today": {record}}
+    "today" is optional, the record of the current date is used when it is missing."""
+
+    def __init__(self, path=REPLAY_FILE):
+        self.path = path
+
+    def fetch(self, obj, days_history, days_forecast):
+        with open(self.path, 'r') as f:
+            data = json.load(f)
+        days = data.get('days', {})
+        today = datetime.date.today()
+
+        def records(offsets):
+            result = {}
+            for index in offsets:
+                record = days.get((today + datetime.timedelta(days=index)).strftime('%Y-%m-%d'))
+                if record is not None:
+                    result[index] = record
+            return result
+
+        history = records(range(-1, -1 - days_history, -1))
+        forecast = records(range(days_forecast + 1))
+        return history, forecast, data.get('today', forecast.get(0, {}))
+
+    def location(self):
+        return self.path
+
+
+PROVIDERS = {
+    'wunderground': WundergroundProvider,
+    'replay': ReplayProvider
+}
+
+
+def get_provider(name):
+    if name not in PROVIDERS:
+        raise Exception('Unknown weather provider: ' + name)
+    return PROVIDERS[name]()
+
+
+################################################################################
+# Wunderground queries:                                                        #
+################################################################################
+
+def history_info(obj, lid, days_history):
+    if days_history == 0:
+        return {}
+
+    today = datetime.date.today()
 
     result = {}
-    for index, day_info in info.iteritems():
+    missing = []
+    for index in range(-1, -1 - days_history, -1):
+        check_date = today + datetime.timedelta(days=index)
+        record = weather_store.get(lid, check_date, 'history')  # past days never change
+        if record is not None:
+            result[index] = record
+        else:
+            missing.append((index, check_date))
+
+    requests = ["history_"+check_date.strftime('%Y%m%d')+"/q/"+lid+".json" for index, check_date in missing]
+    for (index, check_date), data in zip(missing, fetch_pool.map(get_data, requests)):  # concurrently
+        if not data or len(data['history']['dailysummary']) == 0:
+            continue
+        day_info = data['history']['dailysummary'][0]
         try:
             result[index] = {
                 'temp_c': safe_float(day_info['maxtempm']) if day_info['maxtempm'].replace(".","").isdigit() else 0,
+                'tmin_c': safe_float(day_info['mintempm']) if day_info['mintempm'].replace(".","").isdigit() else 0,
                 'rain_mm': safe_float(day_info['precipm']) if day_info['precipm'].replace(".","").isdigit() else 0,
                 'wind_ms': safe_float(day_info['meanwindspdm']) / 3.6 if day_info['meanwindspdm'].replace(".","").isdigit() else 0,
                 'humidity': safe_float(day_info['humidity']) if day_info['humidity'].replace(".","").isdigit() else 0
@@ -343,20 +593,14 @@ def history_info(obj):
         except ValueError:
             obj.add_status("Skipped wundergound data because of a parsing error for %s" % day_info['date']['pretty'])
             continue
+        weather_store.put(lid, check_date, 'history', result[index])
 
     return result
 
 
-def today_info(obj):
-    lid = get_wunderground_lid()
-    if lid == "":
-        raise Exception('No Location ID found!')
-
-    datestring = datetime.date.today().strftime('%Y%m%d')
-
+def today_info(obj, lid):
     request = "conditions/q/"+lid+".json"
-    name = "conditions_"+datestring+"/q/"+lid+".json"
-    data = get_data(request, name, True)
+    data = get_data(request)  # current conditions are always fetched
 
     day_info = data['current_observation']
 
@@ -374,18 +618,22 @@ def today_info(obj):
     return result
 
 
-def forecast_info(obj):
-    options = options_data()
-
-    lid = get_wunderground_lid()
-    if lid == "":
-        raise Exception('No Location ID found!')
+def forecast_info(obj, lid, days_forecast):
+    today = datetime.date.today()
+    fetched = today.strftime('%Y-%m-%d')
 
-    datestring = datetime.date.today().strftime('%Y%m%d')
+    # The forecast is fetched once a day, later checks that day use the stored records
+    result = {}
+    for index in range(days_forecast + 1):
+        record = weather_store.get(lid, today + datetime.timedelta(days=index), 'forecast')
+        if record is None or record.get('fetched') != fetched:
+            break
+        result[index] = dict((key, value) for key, value in record.iteritems() if key != 'fetched')
+    else:
+        return result
 
     request = "forecast10day/q/"+lid+".json"
-    name = "forecast10day_"+datestring+"/q/"+lid+".json"
-    data = get_data(request, name)
+    data = get_data(request)
 
     info = {}
     for day_index, entry in enumerate(data['forecast']['simpleforecast']['forecastday']):
@@ -393,16 +641,19 @@ def forecast_info(obj):
 
     result = {}
     for index, day_info in info.iteritems():
-        if index <= int(options['days_forecast']):
-            try:
-                result[index] = {
-                    'temp_c': safe_float(day_info['high']['celsius']),
-                    'rain_mm': safe_float(day_info['qpf_allday']['mm']),
-                    'wind_ms': safe_float(day_info['avewind']['kph']) / 3.6,
-                    'humidity': safe_float(day_info['avehumidity'])
-                }
-            except ValueError:
-                obj.add_status("Skipped wundergound data because of a parsing error for forecast day %s" % index)
-                continue
+        try:
+            record = {
+                'temp_c': safe_float(day_info['high']['celsius']),
+                'tmin_c': safe_float(day_info['low']['celsius']),
+                'rain_mm': safe_float(day_info['qpf_allday']['mm']),
+                'wind_ms': safe_float(day_info['avewind']['kph']) / 3.6,
+                'humidity': safe_float(day_info['avehumidity'])
+            }
+        except ValueError:
+            obj.add_status("Skipped wundergound data because of a parsing error for forecast day %s" % index)
+            continue
+        weather_store.put(lid, today + datetime.timedelta(days=index), 'forecast', dict(record, fetched=fetched))
+        if index <= days_forecast:
+            result[index] = record
 
     return result